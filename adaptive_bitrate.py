@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Closed loop encoder bitrate control driven by the RTCP receiver reports of the RTSP sessions
+from collections import namedtuple
+from time import time
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GObject
+
+# loss as a fraction, jitter and round trip time in seconds
+ReceiverReport = namedtuple('ReceiverReport', ['ssrc', 'loss', 'jitter', 'rtt'])
+
+
+def receiver_reports(rtsp_media):
+    reports = []
+    for index in range(rtsp_media.n_streams()):
+        session = rtsp_media.get_stream(index).get_rtpsession()
+        if session is None:
+            continue
+        stats = session.get_property('stats')
+        sources = stats.get_value('source-stats') if stats is not None else None
+        for source in sources or []:
+            if not source.get_value('have-rb'):
+                continue
+            clock_rate = source.get_value('clock-rate')
+            reports.append(ReceiverReport(
+                # a new report block has a new extended highest sequence number, used to skip repeated ones
+                ssrc=(source.get_value('ssrc'), source.get_value('rb-exthighestseq')),
+                loss=source.get_value('rb-fractionlost') / 256.,
+                jitter=source.get_value('rb-jitter') / float(clock_rate if clock_rate > 0 else 90000),
+                rtt=source.get_value('rb-round-trip') / 65536.,
+            ))
+    return reports
+
+
+class BitrateController:
+    """Adjusts one encoder's bitrate property from the receiver reports of every media attached to it.
+
+    Heavy loss backs off proportionally to the loss, moderate loss holds, a round trip time growing well above the
+    lowest one seen backs off gently, and otherwise the bitrate probes upwards, always within [minimum, maximum].
+    Every decision is appended to log as a CSV time series. With close_log the controller owns the log and closes it
+    on the main loop once it stopped, after the last write.
+    """
+
+    def __init__(self, encoder, minimum, maximum, initial=None, property_name='bitrate', interval=1., log=None,
+                 name='encoder', close_log=False):
+        self.encoder = encoder
+        self.minimum = minimum
+        self.maximum = maximum
+        self.property_name = property_name
+        self.interval = interval
+        self.log = log
+        self.close_log = close_log
+        self.name = name
+        self.bitrate = initial or encoder.get_property(property_name)
+        self.medias = []
+        self.decisions = {}
+        self.seen = set()
+        self.min_rtt = None
+        self.running = False
+        self.high_loss = 0.10
+        self.low_loss = 0.02
+        self.rtt_factor = 2.
+        self.increase = 1.05
+        self.delay_decrease = 0.85
+        self.encoder.set_property(self.property_name, int(self.bitrate))
+
+    def add_media(self, rtsp_media):
+        self.medias.append(rtsp_media)
+        rtsp_media.connect('unprepared', self.remove_media)
+
+    def remove_media(self, rtsp_media):
+        if rtsp_media in self.medias:
+            self.medias.remove(rtsp_media)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            GObject.timeout_add(int(self.interval * 1000), self.tick)
+
+    def stop(self, *args):
+        self.running = False
+
+    def decide(self, reports):
+        loss = max(report.loss for report in reports)
+        rtt = max(report.rtt for report in reports)
+        # a report without a round trip time has 0, it only means the sender report was not seen yet
+        rtts = [report.rtt for report in reports if report.rtt > 0]
+        if rtts:
+            self.min_rtt = min(rtts + ([self.min_rtt] if self.min_rtt is not None else []))
+
+        if loss > self.high_loss:
+            return self.bitrate * (1. - loss / 2.), 'loss'
+        if loss > self.low_loss:
+            return self.bitrate, 'hold'
+        if self.min_rtt is not None and rtt > self.rtt_factor * self.min_rtt and rtt > 0.05:
+            return self.bitrate * self.delay_decrease, 'delay'
+        return self.bitrate * self.increase, 'increase'
+
+    def tick(self):
+        if not self.running:
+            if self.close_log and self.log is not None:
+                self.log.close()
+                self.log = None
+            return False
+        reports = []
+        for rtsp_media in list(self.medias):
+            reports.extend(report for report in receiver_reports(rtsp_media) if report.ssrc not in self.seen)
+        self.seen.update(report.ssrc for report in reports)
+        if len(self.seen) > 4096:
+            self.seen = set(report.ssrc for report in reports)
+        if not reports:
+            return True
+
+        bitrate, decision = self.decide(reports)
+        bitrate = int(min(max(bitrate, self.minimum), self.maximum))
+        if bitrate != int(self.bitrate):
+            self.encoder.set_property(self.property_name, bitrate)
+        self.bitrate = bitrate
+        self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        if self.log is not None:
+            self.log.write('{:.3f},{},{},{},{:.4f},{:.2f},{:.2f}\n'.format(
+                time(), self.name, decision, bitrate, max(r.loss for r in reports),
+                max(r.jitter for r in reports) * 1000, max(r.rtt for r in reports) * 1000))
+            self.log.flush()
+        return True
+
+    def __str__(self):
+        return 'name -> {}, bitrate -> {}, bounds -> {}-{}, medias -> {}, decisions -> {}'.format(
+            self.name, int(self.bitrate), self.minimum, self.maximum, len(self.medias), self.decisions)
+
+
+def open_bitrate_log(path='adaptive_bitrate.csv'):
+    log = open(path, 'a')
+    if log.tell() == 0:
+        log.write('time,encoder,decision,bitrate,loss,jitter_ms,rtt_ms\n')
+    return log
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# N synthetic cameras, each with its own frame source, encoder and mount point /camN, added one by one to find how
+# many streams the host sustains before frame pacing degrades, e.g.
+#   python3 camera_farm_server.py --cameras 24 --ramp 10 --csv farm.csv
+# Every report is one point of the cost curve: cameras running, server CPU, CPU per stream and the delivered fps.
+import argparse
+import os
+import statistics
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+from gi.repository import GLib, Gst, GstRtspServer, GObject
+
+from camera_hub import CameraHub, HubMediaFactory
+from frame_sources import open_frame_source
+from rtsp_load_generator import ProcessCpu
+
+
+class FarmCamera:
+    """One CameraHub encoding a frame source continuously, whether clients are connected or not."""
+
+    def __init__(self, index, width, height, fps, encoder, spec):
+        self.mount = '/cam{}'.format(index)
+        self.source = open_frame_source(width, height, fps, spec)
+        # the encode time is a column of the cost curve
+        self.hub = CameraHub(self.source, width, height, fps=fps, encoder=encoder, time_encoder=True)
+        self.factory = HubMediaFactory(self.hub)
+        self.last = self.sample()
+
+    def sample(self):
+        timer = self.hub.encode_timers[self.hub.renditions[0].name]
+        late = self.source.pacer.late if self.source.pacer is not None else 0
+        return timer.frames, timer.total, late, self.hub.prefetcher.dropped
+
+    def take_window(self):
+        current = self.sample()
+        window = tuple(now - then for now, then in zip(current, self.last))
+        self.last = current
+        return window
+
+
+class CameraFarm:
+    def __init__(self, server, cameras, ramp, width, height, fps, encoder, spec, tolerance=.95, csv=None,
+                 exit_after_ramp=False):
+        self.server = server
+        self.cameras = cameras
+        self.ramp = ramp
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.encoder = encoder
+        self.spec = spec
+        self.tolerance = tolerance
+        self.csv = csv
+        self.exit_after_ramp = exit_after_ramp
+        self.running = []
+        self.cpu = ProcessCpu(os.getpid())
+        self.curve = []
+        self.sustained = 0
+        self.degraded = False
+        self.ramping = True
+        self.loop = GObject.MainLoop()
+
+    def start(self):
+        if self.csv is not None:
+            self.csv.write('cameras,cpu,cpu_per_stream,fps_avg,fps_min,encode_ms,late,dropped\n')
+        self.add_camera()
+        GLib.timeout_add(int(self.ramp * 1000), self.step)
+        self.loop.run()
+
+    def add_camera(self):
+        camera = FarmCamera(len(self.running), self.width, self.height, self.fps, self.encoder, self.spec)
+        self.server.get_mount_points().add_factory(camera.mount, camera.factory)
+        camera.hub.start()
+        self.running.append(camera)
+        print('camera {} on rtsp://127.0.0.1:{}{}'.format(len(self.running), self.server.get_service(), camera.mount))
+
+    def step(self):
+        self.report()
+        if not self.ramping:
+            return True
+        if not self.degraded and len(self.running) < self.cameras:
+            self.add_camera()
+            return True
+        self.ramping = False
+        self.summary()
+        if not self.exit_after_ramp:
+            # keep serving the cameras running and keep reporting
+            return True
+        for camera in self.running:
+            camera.hub.stop()
+        self.loop.quit()
+        return False
+
+    def report(self):
+        fps, encode, late, dropped = [], [], 0, 0
+        for camera in self.running:
+            frames, total, window_late, window_dropped = camera.take_window()
+            fps.append(frames / self.ramp)
+            if frames:
+                encode.append(total / frames)
+            late += window_late
+            dropped += window_dropped
+        cpu = self.cpu.percent() or 0.
+        point = (len(self.running), cpu, cpu / len(self.running), statistics.mean(fps), min(fps),
+                 statistics.mean(encode) * 1000 if encode else 0., late, dropped)
+        self.curve.append(point)
+        if min(fps) >= self.fps * self.tolerance:
+            self.sustained = max(self.sustained, len(self.running))
+        elif not self.degraded:
+            self.degraded = True
+            print('frame pacing degraded at {} cameras'.format(len(self.running)))
+        print('cameras -> {}, cpu -> {:.0f} %, per stream -> {:.1f} %, fps avg -> {:.1f}, min -> {:.1f}, '
+              'encode avg -> {:.1f} ms, late frames -> {}, dropped -> {}'.format(*point))
+        if self.csv is not None:
+            self.csv.write('{},{:.1f},{:.2f},{:.2f},{:.2f},{:.2f},{},{}\n'.format(*point))
+            self.csv.flush()
+
+    def summary(self):
+        print('{}x{}@{} sustained -> {} streams on {} cores'.format(self.width, self.height, self.fps,
+                                                                    self.sustained, os.cpu_count()))
+        for cameras, cpu, per_stream, fps_avg, fps_min, encode, late, dropped in self.curve:
+            print('  {:3d} cameras -> {:6.1f} % cpu, {:5.1f} % per stream, fps min -> {:.1f}'.format(
+                cameras, cpu, per_stream, fps_min))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTSP server with N synthetic cameras, ramped to find its capacity')
+    parser.add_argument('--cameras', type=int, default=16, help='cameras added in total')
+    parser.add_argument('--ramp', type=float, default=10., help='seconds between two cameras, also the report window')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=float, default=30.)
+    parser.add_argument('--encoder', default='x264enc speed-preset=ultrafast tune=zerolatency')
+    parser.add_argument('--source', default=os.environ.get('FRAME_SOURCE', 'pattern'),
+                        help='frame source of every camera, as in FRAME_SOURCE')
+    parser.add_argument('--tolerance', type=float, default=.95,
+                        help='pacing degrades when a camera delivers less than this fraction of --fps')
+    parser.add_argument('--csv', help='also write the cost curve to this csv file')
+    parser.add_argument('--exit', action='store_true', help='quit once the ramp is over instead of serving on')
+    args = parser.parse_args()
+
+    Gst.init(None)
+    server = GstRtspServer.RTSPServer()
+    server.attach(None)
+    csv = open(args.csv, 'w') if args.csv else None
+    CameraFarm(server, args.cameras, args.ramp, args.width, args.height, args.fps, args.encoder, args.source,
+               args.tolerance, csv, args.exit).start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# One capture and one encoder per camera, fanned out to any number of RTSP mount points and clients
+from collections import namedtuple
+from threading import Thread
+from time import monotonic
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstRtspServer, GstVideo
+
+from adaptive_bitrate import BitrateController
+from capture_prefetcher import CapturePrefetcher
+from colour_conversion import make_conversion_stage
+from frame_buffers import FrameBufferPool, push_frame
+from gop_cache import GopCache
+from lazy_capture import LazyCapture
+from metrics import EncodeTimer, MediaMetrics
+
+# bitrate is given to the encoder as its bitrate property, None keeps the encoder default
+Rendition = namedtuple('Rendition', ['name', 'width', 'height', 'bitrate'])
+
+
+class CameraHub:
+    """Captures, converts and encodes one camera once.
+
+    Encoded access units go through a GopCache, which replays the current GOP to every new client and then forwards
+    the live stream to it, so adding mounts or clients never adds an encoder.
+
+    With several renditions the converted frames are teed into one scale and encode branch per rendition. Branches
+    are ordered from the largest to the smallest size and each one scales from the previous scaled output, so a
+    downscale is shared by every smaller rendition.
+
+    With adaptive_bitrate every rendition that has a bitrate gets a BitrateController, fed by the receiver reports of
+    all the clients of that rendition and bounded between a quarter of the rendition bitrate and the bitrate itself.
+
+    cap is a cv2.VideoCapture, read as long as the hub runs, or a LazyCapture, open only while clients are attached;
+    the encoder then idles while the camera is closed. Its GOP caches are cleared when the camera closes and a keyframe
+    is requested from the encoders when it reopens, so no client is sent frames of a previous session. Frames are
+    pushed at most at fps, a camera running faster has the frames in between dropped, otherwise the stream would play
+    in slow motion.
+
+    gop_frames is the GOP length the encoder is set to, the GOP caches then hold up to a whole GOP. With time_encoder
+    every encoder gets an EncodeTimer, a probe on each of its buffers.
+    """
+
+    def __init__(self, cap, width, height, fps=30., encoder='x264enc speed-preset=ultrafast tune=zerolatency',
+                 conversion='cv2', buffer_frames=3, use_buffer_pool=False, renditions=None, adaptive_bitrate=False,
+                 bitrate_log=None, gop_frames=None,
+                 time_encoder=False):
+        self.cap = cap
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.duration = int(1 / self.fps * Gst.SECOND)  # duration of a frame in nanoseconds
+        self.buffer_frames = buffer_frames
+        self.use_buffer_pool = use_buffer_pool
+        self.pool = None
+        self.frame_timeout = 1.
+        self.prefetcher = cap if isinstance(cap, LazyCapture) else CapturePrefetcher(cap)
+        if isinstance(cap, LazyCapture):
+            cap.on_open.append(self.force_key_unit)
+            cap.on_close.append(self.clear_gop_caches)
+        self.conversion = make_conversion_stage(width, height, conversion)
+        self.renditions = sorted(renditions or [Rendition('main', width, height, None)],
+                                 key=lambda rendition: rendition.width * rendition.height, reverse=True)
+        self.launch_string = self.build_launch_string(encoder)
+        self.gop_caches = {rendition.name: GopCache(max_frames=gop_frames) for rendition in self.renditions}
+        self.encode_timers = {}
+        if time_encoder:
+            self.encode_timers = {rendition.name: EncodeTimer() for rendition in self.renditions}
+        self.adaptive_bitrate = adaptive_bitrate
+        self.bitrate_log = bitrate_log
+        self.bitrate_controllers = {}
+        self.pipeline = None
+        self.media_metrics = None
+        self.timestamp = 0
+        self.need_data = False
+        # monotonic time the next frame is due at, frames on a grid of 1 / fps seconds
+        self.next_frame_time = None
+        self.rate_dropped = 0
+
+    def build_launch_string(self, encoder):
+        launch_string = 'appsrc name=source is-live=true format=GST_FORMAT_TIME ' \
+                        'caps=video/x-raw,format={},width={},height={},framerate={}/1 ' \
+                        '! {}tee name=scaled_source '.format(self.conversion.input_format, self.width, self.height,
+                                                           int(self.fps), self.conversion.launch_fragment())
+        scaled, size = 'scaled_source', (self.width, self.height)
+        for rendition in self.renditions:
+            if (rendition.width, rendition.height) != size:
+                launch_string += '{}. ! queue max-size-buffers=3 leaky=downstream ! videoscale ' \
+                                 '! video/x-raw,width={},height={} ! tee name=scaled_{} '.format(
+                                     scaled, rendition.width, rendition.height, rendition.name)
+                scaled, size = 'scaled_{}'.format(rendition.name), (rendition.width, rendition.height)
+            bitrate = '' if rendition.bitrate is None else ' bitrate={}'.format(rendition.bitrate)
+            launch_string += '{}. ! queue max-size-buffers=3 leaky=downstream ! {}{} name=encoder_{} ' \
+                             '! h264parse config-interval=-1 ' \
+                             '! video/x-h264,stream-format=byte-stream,alignment=au ' \
+                             '! appsink name=sink_{} emit-signals=true sync=false '.format(
+                                 scaled, encoder, bitrate, rendition.name, rendition.name)
+        return launch_string
+
+    @property
+    def gop_cache(self):
+        return self.gop_caches[self.renditions[0].name]
+
+    def gop_cache_for(self, rendition=None):
+        return self.gop_cache if rendition is None else self.gop_caches[rendition]
+
+    def bitrate_controller_for(self, rendition=None):
+        return self.bitrate_controllers.get(rendition or self.renditions[0].name)
+
+    def encoder_for(self, rendition=None):
+        if self.pipeline is None:
+            return None
+        return self.pipeline.get_by_name('encoder_{}'.format(rendition or self.renditions[0].name))
+
+    def clear_gop_caches(self):
+        for gop_cache in self.gop_caches.values():
+            gop_cache.clear()
+
+    def force_key_unit(self):
+        for rendition in self.renditions:
+            encoder = self.encoder_for(rendition.name)
+            if encoder is not None:
+                event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+                encoder.get_static_pad('src').send_event(event)
+
+    def attach(self, rtsp_media):
+        # keeps a lazily opened camera open until the media is unprepared
+        if isinstance(self.prefetcher, LazyCapture):
+            self.prefetcher.attach(rtsp_media)
+
+    def start(self):
+        print(self.launch_string)
+        self.prefetcher.start()
+        self.pipeline = Gst.parse_launch(self.launch_string)
+        self.pipeline.get_bus().add_signal_watch()
+        self.pipeline.get_bus().connect('message::error', self.on_error)
+        appsrc = self.pipeline.get_by_name('source')
+        self.media_metrics = MediaMetrics('hub', appsrc=appsrc)
+        if self.use_buffer_pool:
+            self.pool = FrameBufferPool(appsrc.get_property('caps'), self.buffer_frames)
+        appsrc.connect('need-data', self.on_need_data)
+        appsrc.connect('enough-data', self.on_enough_data)
+        for rendition in self.renditions:
+            sink = self.pipeline.get_by_name('sink_{}'.format(rendition.name))
+            sink.connect('new-sample', self.gop_caches[rendition.name].on_new_sample)
+            if rendition.name in self.encode_timers:
+                self.encode_timers[rendition.name].attach(self.encoder_for(rendition.name))
+            if self.adaptive_bitrate and rendition.bitrate is not None:
+                controller = BitrateController(self.encoder_for(rendition.name), rendition.bitrate // 4,
+                                               rendition.bitrate, initial=rendition.bitrate, log=self.bitrate_log,
+                                               name=rendition.name)
+                self.bitrate_controllers[rendition.name] = controller
+                controller.start()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        self.need_data = False
+        self.prefetcher.stop()
+        for controller in self.bitrate_controllers.values():
+            controller.stop()
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.media_metrics is not None:
+            self.media_metrics.close()
+            self.media_metrics = None
+
+    def on_need_data(self, src, lenght):
+        self.need_data = True
+        while self.need_data:
+            frame = self.prefetcher.get(self.frame_timeout)
+            if frame is None:
+                if not self.prefetcher.running:
+                    self.need_data = False
+                continue
+            if not self.due():
+                self.rate_dropped += 1
+                continue
+            retval = push_frame(src, self.conversion(frame), self.timestamp, self.duration, pool=self.pool)
+            self.timestamp += self.duration
+            self.media_metrics.pushed(retval)
+            if retval != Gst.FlowReturn.OK:
+                print(retval)
+                self.need_data = False
+
+    def due(self):
+        # half a period of slack keeps a camera running at fps from losing frames to jitter
+        now, period = monotonic(), 1. / self.fps
+        if self.next_frame_time is None or now - self.next_frame_time > period:
+            self.next_frame_time = now
+        elif now < self.next_frame_time - period / 2:
+            return False
+        self.next_frame_time += period
+        return True
+
+    def on_enough_data(self, src):
+        self.need_data = False
+
+    def on_error(self, bus, message):
+        print('hub error message -> {}'.format(message.parse_error().debug))
+
+    def collect(self):
+        samples = [
+            ('gst_capture_frames_total', {'factory': 'hub'}, self.prefetcher.captured),
+            ('gst_frames_dropped_total', {'factory': 'hub', 'reason': 'capture'}, self.prefetcher.dropped),
+            ('gst_frames_dropped_total', {'factory': 'hub', 'reason': 'rate'}, self.rate_dropped),
+        ]
+        samples.extend(self.prefetcher.collect(factory='hub'))
+        if self.pool is not None:
+            samples.append(('gst_buffer_pool_dry_total', {'factory': 'hub'}, self.pool.dry))
+        for rendition in self.renditions:
+            labels = {'factory': 'hub', 'rendition': rendition.name}
+            if rendition.name in self.encode_timers:
+                samples.extend(self.encode_timers[rendition.name].collect(**labels))
+            samples.extend(self.gop_caches[rendition.name].collect(**labels))
+            if rendition.name in self.bitrate_controllers:
+                samples.append(('gst_encoder_bitrate', labels, int(self.bitrate_controllers[rendition.name].bitrate)))
+        return samples
+
+    def __str__(self):
+        text = '{}: {}'.format('camera' if isinstance(self.prefetcher, LazyCapture) else 'prefetcher', self.prefetcher)
+        if self.pool is not None:
+            text += '\nbuffer_pool: {}'.format(self.pool)
+        for rendition in self.renditions:
+            text += '\n{} {}x{}: {}, gop_cache: {}'.format(rendition.name, rendition.width, rendition.height,
+                                                         self.encode_timers.get(rendition.name, 'untimed'),
+                                                         self.gop_caches[rendition.name])
+            if rendition.name in self.bitrate_controllers:
+                text += '\n{} bitrate_controller: {}'.format(rendition.name, self.bitrate_controllers[rendition.name])
+        return text
+
+
+class HubMediaFactory(GstRtspServer.RTSPMediaFactory):
+    """Mount point attached to a CameraHub; every client gets its own payloader but no encoder."""
+
+    def __init__(self, hub, rendition=None, **properties):
+        super(HubMediaFactory, self).__init__(**properties)
+        self.hub = hub
+        self.rendition = rendition
+        self.gop_cache = hub.gop_cache_for(rendition)
+        self.launch_string = '( appsrc name=source is-live=true format=GST_FORMAT_TIME ' \
+                             'caps=video/x-h264,stream-format=byte-stream,alignment=au ' \
+                             '! h264parse ! rtph264pay config-interval=1 name=pay0 pt=96 )'
+        self.set_launch(self.launch_string)
+        self.set_shared(False)
+        self.set_eos_shutdown(True)
+        self.set_latency(500)
+
+    def on_need_data(self, src, lenght, subscriber):
+        # the first need-data tells the client appsrc is started and can take the cached GOP, replayed from another
+        # thread so this streaming thread can drain it meanwhile
+        if not subscriber.subscribing:
+            subscriber.subscribing = True
+            Thread(target=self.gop_cache.subscribe, args=(subscriber,), daemon=True).start()
+
+    def on_unprepared(self, rtsp_media, subscriber):
+        self.gop_cache.unsubscribe(subscriber)
+
+    def do_configure(self, rtsp_media):
+        element = rtsp_media.get_element()
+        appsrc = element.get_child_by_name('source')
+        self.hub.attach(rtsp_media)
+        subscriber = self.gop_cache.subscriber(appsrc)
+        subscriber.media_metrics = MediaMetrics('hub/{}'.format(self.rendition or 'main'), rtsp_media, appsrc)
+        payloader = element.get_child_by_name('pay0')
+        payloader.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, subscriber.on_first_frame)
+        appsrc.connect('need-data', self.on_need_data, subscriber)
+        rtsp_media.connect('unprepared', self.on_unprepared, subscriber)
+        controller = self.hub.bitrate_controller_for(self.rendition)
+        if controller is not None:
+            controller.add_media(rtsp_media)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Reads a capture device on its own thread so camera latency never lands on the GStreamer streaming thread
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+
+
+class CapturePrefetcher(Thread):
+    """Grabs frames from a cv2.VideoCapture into a bounded queue, dropping the oldest frame when it is full.
+
+    A failed read is retried after failure_wait seconds; after max_failures failed reads in a row the capture is taken
+    as gone and the prefetcher stops, so its owner can notice through running.
+    """
+
+    def __init__(self, cap, maxsize=2, max_failures=50, failure_wait=.1):
+        super(CapturePrefetcher, self).__init__(daemon=True)
+        self.cap = cap
+        self.frames = deque(maxlen=maxsize)
+        self.condition = Condition()
+        self.stopped = False
+        self.captured = 0
+        self.dropped = 0
+        self.failures = 0
+        self.max_failures = max_failures
+        self.failure_wait = failure_wait
+        self.pushed = 0
+        self.latency_total = 0.
+        self.latency_max = 0.
+
+    def run(self):
+        while not self.stopped and self.cap.isOpened():
+            ret, frame = self.cap.read()
+            if not ret:
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    print('capture failed {} reads in a row, stopping'.format(self.failures))
+                    break
+                with self.condition:
+                    self.condition.wait_for(lambda: self.stopped, self.failure_wait)
+                continue
+            self.failures = 0
+            timestamp = monotonic()
+            with self.condition:
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                self.frames.append((frame, timestamp))
+                self.captured += 1
+                self.condition.notify()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        # only dequeues, returns None when no frame was captured within timeout or the prefetcher stopped
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames or self.stopped, timeout) or not self.frames:
+                return None
+            frame, timestamp = self.frames.popleft()
+        latency = monotonic() - timestamp
+        self.pushed += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        return frame
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def collect(self, **labels):
+        if not self.pushed:
+            return []
+        return [('gst_capture_to_push_seconds', labels, round(self.latency_total / self.pushed, 6)),
+                ('gst_capture_to_push_max_seconds', labels, round(self.latency_max, 6))]
+
+    @property
+    def running(self):
+        return not self.stopped
+
+    def __str__(self):
+        average = self.latency_total / self.pushed if self.pushed else 0.
+        return 'captured -> {}, dropped -> {}, capture to push latency avg -> {:.1f} ms, ' \
+               'max -> {:.1f} ms'.format(self.captured, self.dropped, average * 1000, self.latency_max * 1000)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# BGR to I420 conversion stage, either in python on horizontal stripes spread over a thread pool (cv2 or numpy) or
+# left to a multi-threaded videoconvert element in the pipeline
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import cv2
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+BACKENDS = ('cv2', 'numpy', 'videoconvert')
+
+
+def _cv2_stripe(stripe):
+    return cv2.cvtColor(stripe, cv2.COLOR_BGR2YUV_I420)
+
+
+def _numpy_stripe(stripe):
+    # BT.601 limited range with the same fixed point coefficients and chroma siting as cv2.COLOR_BGR2YUV_I420
+    height, width = stripe.shape[:2]
+    b, g, r = (stripe[..., i].astype(np.int32) for i in range(3))
+    out = np.empty((height * 3 // 2, width), np.uint8)
+    flat = out.reshape(-1)
+    flat[:height * width] = (((66 * r + 129 * g + 25 * b + 128) >> 8) + 16).reshape(-1)
+    b, g, r = b[::2, ::2], g[::2, ::2], r[::2, ::2]
+    chroma = b.size
+    flat[height * width:height * width + chroma] = (((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128).reshape(-1)
+    flat[height * width + chroma:] = (((112 * r - 94 * g - 18 * b + 128) >> 8) + 128).reshape(-1)
+    return out
+
+
+_STRIPE_CONVERTERS = {
+    'cv2': _cv2_stripe,
+    'numpy': _numpy_stripe,
+}
+
+
+class ConversionStage:
+    """BGR to I420 conversion for one resolution.
+
+    Calling the stage converts a BGR frame in python when the backend is cv2 or numpy and returns it untouched for
+    videoconvert; input_format and launch_fragment tell the factory what appsrc caps and elements go with it.
+
+    The python backends convert the whole frame on the calling thread unless stripes is above 1; cv2.cvtColor is
+    already parallel inside, so striping it on a thread pool as well is only worth it where a benchmark says so.
+    """
+
+    def __init__(self, width, height, backend='cv2', threads=None, stripes=None):
+        if backend not in BACKENDS:
+            raise ValueError('unknown conversion backend {}, expected one of {}'.format(backend, BACKENDS))
+        if width % 2 or height % 2:
+            raise ValueError('I420 needs an even frame size, got {}x{}'.format(width, height))
+        self.width = width
+        self.height = height
+        self.backend = backend
+        self.threads = threads or os.cpu_count() or 1
+        self.stripes = stripes or 1
+        # stripe boundaries on even rows, so every stripe owns whole chroma rows
+        rows = height // 2
+        self.bounds = [(2 * (rows * i // self.stripes), 2 * (rows * (i + 1) // self.stripes))
+                       for i in range(self.stripes)]
+        self.bounds = [(top, bottom) for top, bottom in self.bounds if bottom > top]
+        self.executor = None
+        if backend != 'videoconvert' and len(self.bounds) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=min(self.threads, len(self.bounds)),
+                                               thread_name_prefix='conversion')
+
+    @property
+    def input_format(self):
+        return 'BGR' if self.backend == 'videoconvert' else 'I420'
+
+    def launch_fragment(self):
+        if self.backend != 'videoconvert':
+            return ''
+        return 'videoconvert n-threads={} ! video/x-raw,format=I420 ! '.format(self.threads)
+
+    def _convert_stripe(self, frame, out, top, bottom):
+        width, height = self.width, self.height
+        converted = _STRIPE_CONVERTERS[self.backend](frame[top:bottom]).reshape(-1)
+        luma = (bottom - top) * width
+        chroma = luma // 4
+        planes = out.reshape(-1)
+        planes[top * width:bottom * width] = converted[:luma]
+        u = height * width + top * width // 4
+        v = height * width * 5 // 4 + top * width // 4
+        planes[u:u + chroma] = converted[luma:luma + chroma]
+        planes[v:v + chroma] = converted[luma + chroma:]
+
+    def __call__(self, frame, out=None):
+        if self.backend == 'videoconvert':
+            return frame
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        if out is None:
+            out = np.empty((self.height * 3 // 2, self.width), np.uint8)
+        if self.executor is None:
+            for top, bottom in self.bounds:
+                self._convert_stripe(frame, out, top, bottom)
+        else:
+            futures = [self.executor.submit(self._convert_stripe, frame, out, top, bottom)
+                       for top, bottom in self.bounds]
+            for future in futures:
+                future.result()
+        return out
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __str__(self):
+        return 'backend -> {}, threads -> {}, stripes -> {}'.format(self.backend, self.threads, len(self.bounds))
+
+
+def _time_python_stage(stage, frame, iterations):
+    out = np.empty((stage.height * 3 // 2, stage.width), np.uint8)
+    stage(frame, out)
+    start = perf_counter()
+    for _ in range(iterations):
+        stage(frame, out)
+    return (perf_counter() - start) / iterations
+
+
+def _time_videoconvert(width, height, threads, frame, iterations):
+    pipeline = Gst.parse_launch(
+        'appsrc name=source format=GST_FORMAT_TIME caps=video/x-raw,format=BGR,width={},height={},framerate=30/1 '
+        '! videoconvert n-threads={} ! video/x-raw,format=I420 ! fakesink sync=false'.format(width, height, threads))
+    source = pipeline.get_by_name('source')
+    data = GLib.Bytes.new(frame.tobytes())
+
+    def push(i):
+        # a buffer per push, so the queued ones keep their timestamps; they all wrap the same frame bytes
+        buf = Gst.Buffer.new_wrapped_bytes(data)
+        buf.pts = buf.dts = i * Gst.SECOND // 30
+        source.emit('push-buffer', buf)
+
+    pipeline.set_state(Gst.State.PLAYING)
+    # one buffer prerolls the pipeline, so startup and caps negotiation stay out of the timing
+    push(0)
+    pipeline.get_state(Gst.CLOCK_TIME_NONE)
+    start = perf_counter()
+    for i in range(1, iterations + 1):
+        push(i)
+    source.emit('end-of-stream')
+    pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = perf_counter() - start
+    pipeline.set_state(Gst.State.NULL)
+    return elapsed / iterations
+
+
+def benchmark(width, height, threads=None, iterations=30):
+    """Returns {(backend, stripes): seconds per frame} for a random BGR frame of the given size."""
+    threads = threads or os.cpu_count() or 1
+    frame = np.random.randint(0, 256, (height, width, 3), np.uint8)
+    results = {}
+    for backend in _STRIPE_CONVERTERS:
+        for stripes in sorted({1, threads}):
+            stage = ConversionStage(width, height, backend, threads=threads, stripes=stripes)
+            try:
+                results[(backend, stripes)] = _time_python_stage(stage, frame, iterations)
+            finally:
+                stage.close()
+    if Gst.is_initialized():
+        results[('videoconvert', threads)] = _time_videoconvert(width, height, threads, frame, iterations)
+    return results
+
+
+def pick_fastest_backend(width, height, threads=None, iterations=30):
+    results = benchmark(width, height, threads, iterations)
+    for (backend, stripes), seconds in sorted(results.items(), key=lambda item: item[1]):
+        print('conversion {}x{}: {} with {} stripes -> {:.2f} ms/frame'.format(width, height, backend, stripes,
+                                                                             seconds * 1000))
+    backend, stripes = min(results, key=results.get)
+    return ConversionStage(width, height, backend, threads=threads, stripes=stripes)
+
+
+def make_conversion_stage(width, height, backend='cv2', threads=None, stripes=1):
+    # only 'auto' or an explicit stripes stripe the python backends over a thread pool
+    if backend == 'auto':
+        return pick_fastest_backend(width, height, threads)
+    return ConversionStage(width, height, backend, threads=threads, stripes=stripes)
+
+
+if __name__ == '__main__':
+    import sys
+
+    Gst.init(None)
+    width, height = (int(v) for v in sys.argv[1:3]) if len(sys.argv) > 2 else (1280, 720)
+    print('fastest: {}'.format(pick_fastest_backend(width, height)))
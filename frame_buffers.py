@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Helpers to hand numpy frames to an appsrc without copying them through python bytes objects
+
+import ctypes
+import ctypes.util
+from itertools import count
+
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+
+
+class _GstMiniObject(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_size_t),
+        ('refcount', ctypes.c_int),
+        ('lockstate', ctypes.c_int),
+        ('flags', ctypes.c_uint),
+        ('copy', ctypes.c_void_p),
+        ('dispose', ctypes.c_void_p),
+        ('free', ctypes.c_void_p),
+        ('priv_uint', ctypes.c_uint),
+        ('priv_pointer', ctypes.c_void_p),
+    ]
+
+
+class _GstBuffer(ctypes.Structure):
+    _fields_ = [
+        ('mini_object', _GstMiniObject),
+        ('pool', ctypes.c_void_p),
+        ('pts', ctypes.c_uint64),
+        ('dts', ctypes.c_uint64),
+        ('duration', ctypes.c_uint64),
+        ('offset', ctypes.c_uint64),
+        ('offset_end', ctypes.c_uint64),
+    ]
+
+
+_GDestroyNotify = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+
+def _load_library(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        return None
+    try:
+        return ctypes.CDLL(path)
+    except OSError:
+        return None
+
+
+_libgst = _load_library('gstreamer-1.0')
+_libgstapp = _load_library('gstapp-1.0')
+
+if _libgst is not None and _libgstapp is not None:
+    _libgst.gst_buffer_new_wrapped_full.restype = ctypes.POINTER(_GstBuffer)
+    _libgst.gst_buffer_new_wrapped_full.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_size_t,
+                                                    ctypes.c_size_t, ctypes.c_void_p, _GDestroyNotify]
+    _libgstapp.gst_app_src_push_buffer.restype = ctypes.c_int
+    _libgstapp.gst_app_src_push_buffer.argtypes = [ctypes.c_void_p, ctypes.POINTER(_GstBuffer)]
+    ctypes.pythonapi.PyCapsule_GetPointer.restype = ctypes.c_void_p
+    ctypes.pythonapi.PyCapsule_GetPointer.argtypes = [ctypes.py_object, ctypes.c_char_p]
+    ZERO_COPY = True
+else:
+    ZERO_COPY = False
+
+# arrays wrapped by a buffer that gstreamer has not released yet, keyed by the token passed as user_data
+_pinned = {}
+_tokens = count(1)
+
+
+@_GDestroyNotify
+def _release(token):
+    _pinned.pop(token, None)
+
+
+def _set_buffer_times(buf, pts, duration, offset):
+    buf.pts = buf.dts = int(pts)
+    buf.duration = int(duration)
+    if offset is not None:
+        buf.offset = int(offset)
+
+
+def pinned_count():
+    return len(_pinned)
+
+
+def caps_frame_size(caps):
+    info = GstVideo.VideoInfo()
+    if not info.from_caps(caps):
+        raise ValueError('cannot size a frame from caps {}'.format(caps.to_string()))
+    return info.size
+
+
+def _write_frame(buf, frame):
+    ok, info = buf.map(Gst.MapFlags.WRITE)
+    if not ok:
+        raise RuntimeError('cannot map buffer for writing')
+    try:
+        if isinstance(info.data, memoryview) and not info.data.readonly:
+            np.copyto(np.ndarray(frame.shape, frame.dtype, buffer=info.data), frame)
+            return
+    finally:
+        buf.unmap(info)
+    # older bindings hand out a read-only copy of the mapping
+    buf.fill(0, frame.tobytes())
+
+
+class FrameBufferPool:
+    """Fixed ring of frame sized buffers that are recycled once downstream releases them."""
+
+    def __init__(self, caps, n_buffers):
+        self.size = caps_frame_size(caps)
+        self.n_buffers = n_buffers
+        self.pool = Gst.BufferPool.new()
+        config = self.pool.get_config()
+        Gst.BufferPool.config_set_params(config, caps, self.size, n_buffers, n_buffers)
+        if not self.pool.set_config(config) or not self.pool.set_active(True):
+            raise RuntimeError('cannot activate a pool of {} buffers of {} bytes'.format(n_buffers, self.size))
+        self.params = Gst.BufferPoolAcquireParams()
+        self.params.flags = Gst.BufferPoolAcquireFlags.DONTWAIT
+        self.acquired = 0
+        self.dry = 0
+
+    def buffer_for(self, frame):
+        frame = np.ascontiguousarray(frame)
+        if frame.nbytes != self.size:
+            raise ValueError('frame of {} bytes does not fit buffers of {} bytes'.format(frame.nbytes, self.size))
+        self.acquired += 1
+        ret, buf = self.pool.acquire_buffer(self.params)
+        if ret != Gst.FlowReturn.OK:
+            # every buffer is still downstream, fall back to a one-off allocation
+            self.dry += 1
+            buf = Gst.Buffer.new_allocate(None, self.size, None)
+        _write_frame(buf, frame)
+        return buf
+
+    def close(self, *args):
+        self.pool.set_active(False)
+
+    def __str__(self):
+        return 'buffers -> {}, size -> {}, acquired -> {}, dry -> {}'.format(self.n_buffers, self.size,
+                                                                               self.acquired, self.dry)
+
+
+def frame_to_buffer(frame, pts, duration, offset=None):
+    """Copy a frame into a new Gst.Buffer, for callers that need a python buffer object.
+
+    The frame is copied once, straight into the buffer memory, where the bindings map it writable; bindings that only
+    hand out a copy of the mapping go through a bytes object, a second copy.
+    """
+    frame = np.ascontiguousarray(frame)
+    buf = Gst.Buffer.new_allocate(None, frame.nbytes, None)
+    _write_frame(buf, frame)
+    _set_buffer_times(buf, pts, duration, offset)
+    return buf
+
+
+def push_frame(src, frame, pts, duration, offset=None, pool=None):
+    """Push a numpy frame to an appsrc.
+
+    With a FrameBufferPool the frame is copied into a recycled buffer. Otherwise, when libgstreamer can be reached
+    through ctypes, the buffer wraps the array memory directly (read-only) and the array is kept alive until gstreamer
+    frees the buffer, and as a last resort the frame is copied by frame_to_buffer.
+    """
+    if pool is not None:
+        buf = pool.buffer_for(frame)
+        _set_buffer_times(buf, pts, duration, offset)
+        return src.emit('push-buffer', buf)
+
+    if not ZERO_COPY:
+        return src.emit('push-buffer', frame_to_buffer(frame, pts, duration, offset))
+
+    frame = np.ascontiguousarray(frame)
+    token = next(_tokens)
+    _pinned[token] = frame
+    buf = _libgst.gst_buffer_new_wrapped_full(int(Gst.MemoryFlags.READONLY), frame.ctypes.data, frame.nbytes, 0,
+                                              frame.nbytes, token, _release)
+    if not buf:
+        _pinned.pop(token, None)
+        return Gst.FlowReturn.ERROR
+
+    _set_buffer_times(buf.contents, pts, duration, offset)
+    appsrc = ctypes.pythonapi.PyCapsule_GetPointer(src.__gpointer__, None)
+    # gst_app_src_push_buffer takes ownership of the buffer, the array is released by _release
+    return Gst.FlowReturn(_libgstapp.gst_app_src_push_buffer(appsrc, buf))
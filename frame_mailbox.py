@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Latest-frame mailbox shared by one capture thread and any number of medias
+from collections import namedtuple
+from threading import Condition, Lock
+from time import monotonic
+
+Frame = namedtuple('Frame', ['sequence', 'timestamp', 'data'])
+
+
+class LatestFrameMailbox:
+    """Single writer, many readers.
+
+    The writer publishes an immutable Frame by rebinding one attribute, so readers never take a lock to look at the
+    latest frame. The condition is only touched when a reader is actually blocked waiting for a newer frame.
+    """
+
+    def __init__(self):
+        self._latest = Frame(0, None, None)
+        self._condition = Condition()
+        self._waiters = 0
+
+    def publish(self, data, timestamp=None):
+        latest = Frame(self._latest.sequence + 1, monotonic() if timestamp is None else timestamp, data)
+        self._latest = latest
+        if self._waiters:
+            with self._condition:
+                self._condition.notify_all()
+        return latest
+
+    def latest(self):
+        return self._latest
+
+    def newer_than(self, sequence):
+        latest = self._latest
+        return latest if latest.sequence > sequence else None
+
+    def wait_newer(self, sequence, timeout=None, cancelled=None):
+        latest = self._latest
+        if latest.sequence > sequence:
+            return latest
+
+        with self._condition:
+            # the writer reads _waiters after rebinding _latest, so the predicate below cannot miss a frame
+            self._waiters += 1
+            try:
+                self._condition.wait_for(
+                    lambda: self._latest.sequence > sequence or (cancelled is not None and cancelled()), timeout)
+            finally:
+                self._waiters -= 1
+        return self.newer_than(sequence)
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    @staticmethod
+    def lag(frame):
+        # producer to consumer lag of a frame in seconds
+        return monotonic() - frame.timestamp
+
+    def __str__(self):
+        latest = self._latest
+        if latest.timestamp is None:
+            return 'sequence -> 0'
+        return 'sequence -> {}, age -> {:.3f} s'.format(latest.sequence, self.lag(latest))
+
+
+class ConvertedFrameCache:
+    """Converts mailbox frames only when a reader asks for them, once per sequence number.
+
+    Frames nobody pushes are never converted and readers asking for the same frame share one conversion.
+    """
+
+    def __init__(self, convert):
+        self.convert = convert
+        self._cached = Frame(0, None, None)
+        self._lock = Lock()
+        self.converted = 0
+
+    def get(self, frame):
+        cached = self._cached
+        if cached.sequence >= frame.sequence:
+            return cached
+        with self._lock:
+            cached = self._cached
+            if cached.sequence < frame.sequence:
+                cached = Frame(frame.sequence, frame.timestamp, self.convert(frame.data))
+                self._cached = cached
+                self.converted += 1
+        return cached
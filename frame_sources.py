@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# Frame sources with the cv2.VideoCapture read interface, so servers run from a camera, a video file looped from
+# memory, videotestsrc or a numpy pattern, all paced and timestamped the same way.
+# The source is picked with the FRAME_SOURCE environment variable:
+#   camera[:index], file:<path>, videotestsrc[:pattern] or pattern, camera:0 by default
+# and FRAME_BARCODE=1 burns a timestamp barcode of the pts and capture time into every frame
+import abc
+import os
+from time import monotonic, sleep, time
+
+import cv2
+import numpy as np
+
+from timestamp_barcode import TimestampBarcode
+
+
+class Pacer:
+    """Paces reads on an absolute schedule of fps, so timing error never accumulates.
+
+    A read later than a whole frame period resets the schedule instead of bursting to catch up, and is counted.
+    """
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.period = 1. / fps
+        self.started = None
+        self.frames = 0
+        self.late = 0
+
+    def wait(self):
+        now = monotonic()
+        if self.started is None:
+            self.started = now
+        deadline = self.started + self.frames * self.period
+        if deadline > now:
+            sleep(deadline - now)
+        elif now - deadline > self.period:
+            self.late += 1
+            self.started = now - self.frames * self.period
+        self.frames += 1
+
+
+class FrameSource(abc.ABC):
+    """Base of the frame sources: isOpened(), read() and release() like a cv2.VideoCapture.
+
+    Every read waits for its slot in the pacer, then takes the frame; pts is the presentation time of the frame
+    last read in nanoseconds, from its index, and captured_at the monotonic time it was read. With a barcode both
+    the pts and the wall clock time of the read are drawn into the top of the frame.
+    """
+
+    def __init__(self, width, height, fps=30., pace=True):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.duration = int(1e9 / fps)
+        self.pacer = Pacer(fps) if pace else None
+        self.opened = True
+        self.index = -1
+        self.pts = None
+        self.captured_at = None
+        self.barcode = None
+
+    @abc.abstractmethod
+    def next_frame(self):
+        """The next frame as a BGR array, None once there is none."""
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        if self.pacer is not None:
+            self.pacer.wait()
+        frame = self.next_frame()
+        if frame is None:
+            return False, None
+        self.index += 1
+        self.pts = self.index * self.duration
+        self.captured_at = monotonic()
+        if self.barcode is not None:
+            if not frame.flags.writeable:
+                frame = frame.copy()
+            if self.barcode.width != frame.shape[1]:
+                # a camera may not deliver the size it was asked for
+                self.barcode = TimestampBarcode(frame.shape[1])
+            self.barcode.draw_bgr(frame, self.pts, int(time() * 1e6))
+        return True, frame
+
+    def release(self):
+        self.opened = False
+
+    def __str__(self):
+        late = self.pacer.late if self.pacer is not None else 0
+        return '{} {}x{}@{} -> frames {}, late {}'.format(type(self).__name__, self.width, self.height, self.fps,
+                                                          self.index + 1, late)
+
+
+class CameraSource(FrameSource):
+    def __init__(self, width, height, fps=30., device=0, pace=True):
+        super(CameraSource, self).__init__(width, height, fps, pace)
+        self.cap = cv2.VideoCapture(device)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        self.opened = self.cap.isOpened()
+
+    def next_frame(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        if frame.shape[:2] != (self.height, self.width):
+            # a camera may ignore the requested size, the appsrc caps expect it
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def release(self):
+        super(CameraSource, self).release()
+        self.cap.release()
+
+
+class VideoFileSource(FrameSource):
+    """Decodes up to max_frames of a video file once, resized, and loops over them from memory."""
+
+    def __init__(self, path, width, height, fps=30., max_frames=300, pace=True):
+        super(VideoFileSource, self).__init__(width, height, fps, pace)
+        self.frames = []
+        cap = cv2.VideoCapture(path)
+        while len(self.frames) < max_frames:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            frame.flags.writeable = False
+            self.frames.append(frame)
+        cap.release()
+        self.opened = bool(self.frames)
+        print('decoded {} frames of {}'.format(len(self.frames), path))
+
+    def next_frame(self):
+        return self.frames[(self.index + 1) % len(self.frames)]
+
+
+class TestSrcSource(FrameSource):
+    """Frames from a videotestsrc pipeline pulled through an appsink."""
+
+    def __init__(self, width, height, fps=30., pattern='smpte', pace=True):
+        super(TestSrcSource, self).__init__(width, height, fps, pace)
+        import gi
+
+        gi.require_version('Gst', '1.0')
+        gi.require_version('GstVideo', '1.0')
+        from gi.repository import Gst, GstVideo
+
+        if not Gst.is_initialized():
+            Gst.init(None)
+        self.pipeline = Gst.parse_launch(
+            'videotestsrc pattern={} ! video/x-raw,format=BGR,width={},height={},framerate={}/1 '
+            '! appsink name=sink max-buffers=2 sync=false'.format(pattern, width, height, int(fps)))
+        self.sink = self.pipeline.get_by_name('sink')
+        self.info = GstVideo.VideoInfo()
+        self.stride = None
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def next_frame(self):
+        sample = self.sink.emit('pull-sample')
+        if sample is None:
+            return None
+        if self.stride is None:
+            self.info.from_caps(sample.get_caps())
+            self.stride = self.info.stride[0]
+        buf = sample.get_buffer()
+        # rows of a BGR frame are padded to a stride of a multiple of 4 bytes
+        rows = np.ndarray((self.height, self.stride), np.uint8, buffer=buf.extract_dup(0, buf.get_size()))
+        return rows[:, :self.width * 3].reshape(self.height, self.width, 3)
+
+    def release(self):
+        super(TestSrcSource, self).release()
+        from gi.repository import Gst
+
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+class PatternSource(FrameSource):
+    """Colour bars over a luma ramp scrolling down one row per frame, generated once.
+
+    The pattern is drawn twice on top of each other, so every frame is a contiguous view into it.
+    """
+
+    def __init__(self, width, height, fps=30., pace=True):
+        super(PatternSource, self).__init__(width, height, fps, pace)
+        bars = np.array([[255, 255, 255], [0, 255, 255], [255, 255, 0], [0, 255, 0],
+                         [255, 0, 255], [0, 0, 255], [255, 0, 0], [0, 0, 0]], np.uint8)
+        columns = bars[np.arange(width) * len(bars) // width]
+        ramp = np.linspace(0.25, 1., height, dtype=np.float32)[:, None, None]
+        pattern = (columns[None, :, :] * ramp).astype(np.uint8)
+        self.pattern = np.concatenate([pattern, pattern])
+        self.pattern.flags.writeable = False
+
+    def next_frame(self):
+        offset = (self.height - (self.index + 1) % self.height) % self.height
+        return self.pattern[offset:offset + self.height]
+
+
+def open_frame_source(width=1280, height=720, fps=30., spec=None, barcode=None):
+    spec = spec or os.environ.get('FRAME_SOURCE', 'camera')
+    if barcode is None:
+        barcode = os.environ.get('FRAME_BARCODE', '') not in ('', '0')
+    kind, _, argument = spec.partition(':')
+    if kind == 'camera':
+        source = CameraSource(width, height, fps, int(argument or 0))
+    elif kind == 'file':
+        source = VideoFileSource(argument, width, height, fps)
+    elif kind == 'videotestsrc':
+        source = TestSrcSource(width, height, fps, argument or 'smpte')
+    elif kind == 'pattern':
+        source = PatternSource(width, height, fps)
+    else:
+        raise ValueError('unknown frame source {}, expected camera[:index], file:<path>, videotestsrc[:pattern] '
+                         'or pattern'.format(spec))
+    if barcode:
+        source.barcode = TimestampBarcode(width)
+    return source
+
+
+def launch_source(width, height, fps=30, spec=None):
+    """The same choice of source as a launch string fragment producing raw video, for launch string factories.
+
+    A video file is looped by loopingfilesrc rather than from memory and the numpy pattern becomes videotestsrc.
+    Gst must be initialized, loopingfilesrc is registered on the first call.
+    """
+    spec = spec or os.environ.get('FRAME_SOURCE', 'camera')
+    kind, _, argument = spec.partition(':')
+    if kind == 'camera':
+        return 'v4l2src device=/dev/video{}'.format(argument or 0)
+    if kind == 'file':
+        from looping_file_source import register
+
+        register()
+        return 'loopingfilesrc location={} ! videoscale ! videorate ' \
+               '! video/x-raw,width={},height={},framerate={}/1'.format(argument, width, height, int(fps))
+    if kind in ('videotestsrc', 'pattern'):
+        return 'videotestsrc is-live=true pattern={}'.format(argument or 'smpte')
+    raise ValueError('unknown frame source {}'.format(spec))
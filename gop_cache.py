@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# Cache of the last encoded GOP, so clients joining a running encoder start decoding right away
+from threading import Lock
+from time import monotonic
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+def is_keyframe(buf):
+    return not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+
+
+class GopSubscriber:
+    """Feeds one client appsrc, timestamps are rebased so the client stream starts at zero.
+
+    The base is the live pts at subscription time, the live frames then play in real time instead of lagging behind
+    by the age of the cached GOP. The cached GOP goes out before them in one burst, at replay_pts spaced less than a
+    frame apart from zero; it is never skipped for the queued bytes, the client appsrc only drains it afterwards.
+    """
+
+    def __init__(self, appsrc, max_queued_bytes):
+        self.appsrc = appsrc
+        self.max_queued_bytes = max_queued_bytes
+        self.base = None
+        self.waiting_keyframe = True
+        self.created = monotonic()
+        self.subscribing = False
+        self.subscribed = False
+        self.unsubscribed = False
+        self.first_frame = None
+        self.pushed = 0
+        self.dropped = 0
+        self.media_metrics = None
+
+    def push(self, buf, replay_pts=None):
+        keyframe = is_keyframe(buf)
+        if replay_pts is None and self.appsrc.get_property('current-level-bytes') > self.max_queued_bytes:
+            # the client does not keep up, skip to the next keyframe so it can resume decoding
+            self.waiting_keyframe = True
+        if self.waiting_keyframe and not keyframe:
+            self.dropped += 1
+            if self.media_metrics is not None:
+                self.media_metrics.dropped(reason='waiting_keyframe')
+            return Gst.FlowReturn.OK
+        self.waiting_keyframe = False
+
+        if self.base is None:
+            self.base = buf.pts
+        out = buf.copy()
+        out.pts = max(buf.pts - self.base, 0) if replay_pts is None else replay_pts
+        if buf.dts != Gst.CLOCK_TIME_NONE:
+            out.dts = max(buf.dts - self.base, 0) if replay_pts is None else replay_pts
+        self.pushed += 1
+        retval = self.appsrc.emit('push-buffer', out)
+        if self.media_metrics is not None:
+            self.media_metrics.pushed(retval)
+        return retval
+
+    def on_first_frame(self, pad, info):
+        if self.first_frame is None:
+            self.first_frame = monotonic()
+            print('time to first frame {:.3f} s'.format(self.time_to_first_frame))
+        return Gst.PadProbeReturn.REMOVE
+
+    @property
+    def time_to_first_frame(self):
+        if self.first_frame is None:
+            return None
+        return self.first_frame - self.created
+
+
+class GopCache:
+    """Keeps the last keyframe and the frames after it, bounded in bytes and optionally in frames.
+
+    max_frames is meant to be the encoder GOP length, so a whole GOP always fits. When a GOP grows past the bounds the
+    cache is emptied until the next keyframe; late joiners then simply wait for it, as they would without a cache.
+
+    max_queued_bytes is how far a client appsrc may fall behind before it skips to the next keyframe; by default
+    twice max_bytes, so a client still draining a whole replayed GOP keeps the live frames queued behind it.
+    """
+
+    def __init__(self, max_frames=None, max_bytes=8 * 1024 * 1024, max_queued_bytes=None):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.max_queued_bytes = max_queued_bytes or 2 * max_bytes
+        self.lock = Lock()
+        self.samples = []
+        self.bytes = 0
+        self.last_pts = None
+        self.overflows = 0
+        self.subscribers = []
+        self.times_to_first_frame = []
+
+    def add(self, buf):
+        # pushing under the lock keeps every subscriber in cache-then-live order without gaps or duplicates
+        with self.lock:
+            self.last_pts = buf.pts
+            if is_keyframe(buf):
+                self.samples = [buf]
+                self.bytes = buf.get_size()
+            elif self.samples:
+                fits_frames = self.max_frames is None or len(self.samples) < self.max_frames
+                if fits_frames and self.bytes + buf.get_size() <= self.max_bytes:
+                    self.samples.append(buf)
+                    self.bytes += buf.get_size()
+                else:
+                    self.samples = []
+                    self.bytes = 0
+                    self.overflows += 1
+            for subscriber in self.subscribers:
+                subscriber.push(buf)
+
+    def clear(self):
+        # the cached GOP belongs to a capture that is gone, subscribers wait for the next keyframe
+        with self.lock:
+            self.samples = []
+            self.bytes = 0
+            for subscriber in self.subscribers:
+                subscriber.waiting_keyframe = True
+
+    def subscriber(self, appsrc):
+        return GopSubscriber(appsrc, self.max_queued_bytes)
+
+    def subscribe(self, subscriber):
+        # the client appsrc must be started, pushes before that are flushed; called off its streaming thread, which
+        # could not drain the replay while pushing it
+        with self.lock:
+            if subscriber.unsubscribed:
+                return
+            if self.samples:
+                subscriber.base = self.last_pts
+                # every replayed frame ahead of the first live one, which comes about a frame period after zero
+                period = (self.samples[-1].pts - self.samples[0].pts) // max(len(self.samples) - 1, 1)
+                step = min(Gst.MSECOND, max(period // len(self.samples), 1))
+                for i, buf in enumerate(self.samples):
+                    subscriber.push(buf, replay_pts=i * step)
+            self.subscribers.append(subscriber)
+            subscriber.subscribed = True
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscriber.unsubscribed = True
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        if subscriber.time_to_first_frame is not None:
+            self.times_to_first_frame.append(subscriber.time_to_first_frame)
+            del self.times_to_first_frame[:-100]
+
+    def on_new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+        if sample is not None:
+            self.add(sample.get_buffer())
+        return Gst.FlowReturn.OK
+
+    def average_time_to_first_frame(self):
+        # over the last 100 subscribers gone and the current ones, None before any client got a frame
+        with self.lock:
+            current = [s.time_to_first_frame for s in self.subscribers if s.time_to_first_frame is not None]
+        times = self.times_to_first_frame[-100:] + current
+        return sum(times) / len(times) if times else None
+
+    def collect(self, **labels):
+        samples = [('gst_gop_cache_overflows_total', labels, self.overflows)]
+        average = self.average_time_to_first_frame()
+        if average is not None:
+            samples.append(('gst_time_to_first_frame_seconds', labels, round(average, 6)))
+        return samples
+
+    def __str__(self):
+        with self.lock:
+            frames, size, subscribers = len(self.samples), self.bytes, len(self.subscribers)
+        average = self.average_time_to_first_frame() or 0.
+        return 'cached frames -> {}, cached bytes -> {}, overflows -> {}, subscribers -> {}, ' \
+               'time to first frame avg -> {:.3f} s'.format(frames, size, self.overflows, subscribers, average)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# One camera, captured and encoded once, served on several mount points.
+# With --ladder the camera is converted once and encoded as a high/mid/low simulcast ladder instead, mounted on
+# /stream/high, /stream/mid and /stream/low.
+# --adaptive-bitrate lets the encoder bitrates follow the clients' receiver reports, logged to adaptive_bitrate.csv
+import sys
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+from gi.repository import Gst, GstRtspServer, GObject
+
+from adaptive_bitrate import open_bitrate_log
+from camera_hub import CameraHub, HubMediaFactory, Rendition
+from frame_sources import open_frame_source
+from lazy_capture import LazyCapture
+from metrics import add_server_metrics, metrics
+
+
+class GstServer(GstRtspServer.RTSPServer):
+    def __init__(self, hub, mounts, **properties):
+        super(GstServer, self).__init__(**properties)
+        self.hub = hub
+        self.factories = {}
+        for mount, rendition in mounts.items():
+            self.factories[mount] = HubMediaFactory(hub, rendition)
+            self.get_mount_points().add_factory(mount, self.factories[mount])
+        GObject.timeout_add_seconds(60, self.clean_pools)
+        add_server_metrics(self)
+        metrics.add_collector(hub, hub.collect)
+        metrics.serve()
+        self.attach(None)
+
+    def clean_pools(self):
+        clean_count = self.get_session_pool().cleanup()
+        print('Cleaned {} sessions from the pool!'.format(clean_count))
+
+        clean_count = self.get_thread_pool().cleanup()
+        print('Cleaned {} threads from the pool!'.format(clean_count))
+
+        return True
+
+
+Gst.init(None)
+
+encoder = 'x264enc speed-preset=ultrafast tune=zerolatency'
+camera = LazyCapture(lambda: open_frame_source(1280, 720, 30.))
+arguments = [argument for argument in sys.argv[1:] if argument != '--adaptive-bitrate']
+adaptive_bitrate = len(arguments) < len(sys.argv[1:])
+bitrate_log = open_bitrate_log() if adaptive_bitrate else None
+if arguments == ['--ladder']:
+    renditions = [
+        Rendition('high', 1280, 720, 2048),
+        Rendition('mid', 640, 360, 768),
+        Rendition('low', 320, 180, 256),
+    ]
+    hub = CameraHub(camera, 1280, 720, fps=30., encoder=encoder, renditions=renditions,
+                    adaptive_bitrate=adaptive_bitrate, bitrate_log=bitrate_log)
+    mounts = {'/stream/{}'.format(rendition.name): rendition.name for rendition in renditions}
+else:
+    hub = CameraHub(camera, 1280, 720, fps=30., encoder=encoder,
+                    renditions=[Rendition('main', 1280, 720, 2048)], adaptive_bitrate=adaptive_bitrate,
+                    bitrate_log=bitrate_log)
+    mounts = {mount: None for mount in arguments or ['/stream', '/stream2']}
+server = GstServer(hub, mounts)
+hub.start()
+
+loop = GObject.MainLoop()
+try:
+    loop.run()
+finally:
+    if bitrate_log is not None:
+        bitrate_log.close()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Opt-in tracer of the time buffers spend in each element of a media, published as latency histograms
+from bisect import bisect_left
+from collections import OrderedDict
+from time import monotonic
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from metrics import metrics
+
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.)
+
+metrics.describe('gst_element_latency_seconds', 'histogram',
+                 'Time between a buffer leaving the previous element and leaving this one.')
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self.max = 0.
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def samples(self, name, labels):
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append(('{}_bucket'.format(name), dict(labels, le=str(bound)), cumulative))
+        samples.append(('{}_sum'.format(name), labels, round(self.sum, 6)))
+        samples.append(('{}_count'.format(name), labels, self.count))
+        return samples
+
+    def __str__(self):
+        average = self.sum / self.count if self.count else 0.
+        return 'avg -> {:.2f} ms, max -> {:.2f} ms'.format(average * 1000, self.max * 1000)
+
+
+def element_chain(element):
+    """element and everything linked downstream of it through static src pads, in order."""
+    chain = []
+    while element is not None and element not in chain:
+        chain.append(element)
+        pad = element.get_static_pad('src')
+        peer = pad.get_peer() if pad is not None else None
+        element = peer.get_parent_element() if peer is not None else None
+    return chain
+
+
+class LatencyTracer:
+    """Buffer probes on the src pad of every element from a media's appsrc to its payloader.
+
+    A buffer is followed by its pts: the time between it leaving one element and leaving the next is the time it
+    spent in the next one, queueing included. The appsrc is the reference point, so it has no histogram of its own;
+    'total' is the time from the appsrc to the payloader. A payloader splitting a frame into several packets is timed
+    on the first one.
+    """
+
+    def __init__(self, source, labels=None, rtsp_media=None, registry=metrics, max_pending=256):
+        self.chain = element_chain(source)
+        self.labels = labels or {}
+        self.registry = registry
+        self.max_pending = max_pending
+        self.pending = {}
+        self.histograms = OrderedDict((element.get_name(), LatencyHistogram()) for element in self.chain[1:])
+        self.histograms['total'] = LatencyHistogram()
+        self.probes = []
+        for index, element in enumerate(self.chain):
+            pad = element.get_static_pad('src')
+            probe = pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, self.on_buffer, index)
+            self.probes.append((pad, probe))
+        registry.add_collector(self, self.collect)
+        if rtsp_media is not None:
+            rtsp_media.connect('unprepared', self.close)
+
+    def on_buffer(self, pad, info, index):
+        now = monotonic()
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffers = info.get_buffer_list()
+            buf = buffers.get(0) if buffers.length() else None
+        else:
+            buf = info.get_buffer()
+        if buf is None or buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+
+        if index == 0:
+            if len(self.pending) >= self.max_pending:
+                self.pending.clear()
+            self.pending[buf.pts] = [now] + [None] * (len(self.chain) - 1)
+            return Gst.PadProbeReturn.OK
+        times = self.pending.get(buf.pts)
+        if times is None or times[index] is not None or times[index - 1] is None:
+            return Gst.PadProbeReturn.OK
+        times[index] = now
+        self.histograms[self.chain[index].get_name()].observe(now - times[index - 1])
+        if index == len(self.chain) - 1:
+            self.histograms['total'].observe(now - times[0])
+            del self.pending[buf.pts]
+        return Gst.PadProbeReturn.OK
+
+    def collect(self):
+        samples = []
+        for element, histogram in self.histograms.items():
+            samples.extend(histogram.samples('gst_element_latency_seconds', dict(self.labels, element=element)))
+        return samples
+
+    def close(self, *args):
+        self.registry.remove_collector(self)
+        for pad, probe in self.probes:
+            pad.remove_probe(probe)
+        self.probes = []
+
+    def __str__(self):
+        return ', '.join('{} -> {}'.format(element, histogram) for element, histogram in self.histograms.items())
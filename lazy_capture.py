@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Camera opened for the first media that needs it and released once the last one is gone
+from threading import Condition, Timer
+from time import monotonic
+
+from capture_prefetcher import CapturePrefetcher
+from frame_sources import open_frame_source
+
+
+class LazyCapture:
+    """A CapturePrefetcher over a capture that is only open while medias use it.
+
+    Each media attached with attach() keeps the capture open until it is unprepared. After the last one the capture
+    stays open for grace seconds, so a client reconnecting right away doesn't reopen the device. get() and running
+    behave like the prefetcher's; get() waits while the capture is closed.
+
+    A capture that fails to open, or stops delivering, is retried after retry seconds, doubling up to retry_max;
+    get() keeps waiting in the meantime rather than returning right away.
+
+    Callables in on_open and on_close are called without arguments each time the capture is opened or released. A
+    capture is only opened again once the previous one is released and its on_close callables have run, an open
+    arriving in between waits for that.
+    """
+
+    def __init__(self, open_capture=None, grace=5., maxsize=2, retry=1., retry_max=30.):
+        # any callable returning something with the cv2.VideoCapture read interface, see frame_sources
+        self.open_capture = open_capture or open_frame_source
+        self.grace = grace
+        self.maxsize = maxsize
+        self.condition = Condition()
+        self.prefetcher = None
+        self.users = 0
+        self.close_timer = None
+        # set while a capture is being released outside of the condition
+        self.closing = False
+        self.retry = retry
+        self.retry_max = retry_max
+        self.retry_timer = None
+        self.open_failures = 0
+        self.stopped = False
+        self.opens = 0
+        self.closes = 0
+        self.reused = 0
+        self.open_latency = None
+        self.first_frame_latency = None
+        self.close_latency = None
+        self.opened_at = None
+        # totals of the prefetchers already closed, so captured and dropped keep counting across reopens
+        self.closed_captured = 0
+        self.closed_dropped = 0
+        self.on_open = []
+        self.on_close = []
+
+    def start(self):
+        # nothing to start, the capture opens with the first attached media
+        pass
+
+    def attach(self, rtsp_media):
+        self.acquire()
+        rtsp_media.connect('unprepared', self.release)
+
+    def acquire(self):
+        with self.condition:
+            self.users += 1
+            if self.close_timer is not None:
+                self.close_timer.cancel()
+                self.close_timer = None
+                self.reused += 1
+            self.condition.wait_for(lambda: not self.closing)
+            if self.prefetcher is None and self.retry_timer is None and not self.stopped:
+                self.open()
+
+    def release(self, *args):
+        with self.condition:
+            self.users = max(self.users - 1, 0)
+            if self.users == 0 and self.prefetcher is not None and self.close_timer is None:
+                self.close_timer = Timer(self.grace, self.close_if_idle)
+                self.close_timer.daemon = True
+                self.close_timer.start()
+
+    def open(self):
+        started = monotonic()
+        cap = self.open_capture()
+        if not cap.isOpened():
+            cap.release()
+            self.schedule_retry('failed to open')
+            return
+        self.open_latency = monotonic() - started
+        self.opened_at = monotonic()
+        self.first_frame_latency = None
+        self.prefetcher = CapturePrefetcher(cap, self.maxsize)
+        self.prefetcher.start()
+        self.opens += 1
+        self.condition.notify_all()
+        print('capture opened in {:.1f} ms'.format(self.open_latency * 1000))
+        for callback in self.on_open:
+            callback()
+
+    def schedule_retry(self, reason):
+        # called with the condition held
+        self.open_failures += 1
+        delay = min(self.retry_max, self.retry * 2 ** (self.open_failures - 1))
+        print('capture {}, retrying in {:.1f} s'.format(reason, delay))
+        self.retry_timer = Timer(delay, self.retry_open)
+        self.retry_timer.daemon = True
+        self.retry_timer.start()
+
+    def retry_open(self):
+        with self.condition:
+            self.retry_timer = None
+            self.condition.wait_for(lambda: not self.closing)
+            if self.prefetcher is None and self.users > 0 and not self.stopped:
+                self.open()
+
+    def retire(self, prefetcher):
+        self.closed_captured += prefetcher.captured
+        self.closed_dropped += prefetcher.dropped
+        for callback in self.on_close:
+            callback()
+
+    def close_if_idle(self):
+        with self.condition:
+            self.close_timer = None
+        self.close(only_if_idle=True)
+
+    def close(self, only_if_idle=False):
+        with self.condition:
+            if self.prefetcher is None or (only_if_idle and self.users > 0):
+                return
+            prefetcher, self.prefetcher = self.prefetcher, None
+            self.closing = True
+        # joined without the condition held, so get() and acquire() are not stuck behind a slow read()
+        started = monotonic()
+        prefetcher.stop()
+        # the capture can only be released once the prefetcher is out of read()
+        prefetcher.join(1.)
+        prefetcher.cap.release()
+        with self.condition:
+            self.retire(prefetcher)
+            self.close_latency = monotonic() - started
+            self.closes += 1
+            self.closing = False
+            self.condition.notify_all()
+        print('capture closed in {:.1f} ms'.format(self.close_latency * 1000))
+
+    def ready(self):
+        return self.stopped or (self.prefetcher is not None and self.prefetcher.running)
+
+    def get(self, timeout=None):
+        with self.condition:
+            prefetcher = self.prefetcher
+            if prefetcher is not None and not prefetcher.running and not self.stopped:
+                # the source stopped delivering on its own, its thread is gone so it is released right away
+                self.prefetcher = None
+                prefetcher.cap.release()
+                self.retire(prefetcher)
+                self.schedule_retry('stopped delivering')
+            if not self.condition.wait_for(self.ready, timeout):
+                return None
+            prefetcher = self.prefetcher
+        if prefetcher is None:
+            return None
+        frame = prefetcher.get(timeout)
+        if frame is not None and self.first_frame_latency is None:
+            self.first_frame_latency = monotonic() - self.opened_at
+            # the backoff only resets once the source actually delivers
+            self.open_failures = 0
+        return frame
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            for timer in (self.close_timer, self.retry_timer):
+                if timer is not None:
+                    timer.cancel()
+            self.close_timer = self.retry_timer = None
+            self.condition.notify_all()
+        self.close()
+
+    def collect(self, **labels):
+        samples = [('gst_capture_open', labels, int(self.prefetcher is not None))]
+        for name, seconds in (('gst_capture_open_seconds', self.open_latency),
+                              ('gst_capture_first_frame_seconds', self.first_frame_latency),
+                              ('gst_capture_close_seconds', self.close_latency)):
+            if seconds is not None:
+                samples.append((name, labels, round(seconds, 6)))
+        prefetcher = self.prefetcher
+        if prefetcher is not None:
+            samples.extend(prefetcher.collect(**labels))
+        return samples
+
+    @property
+    def running(self):
+        return not self.stopped
+
+    @property
+    def captured(self):
+        prefetcher = self.prefetcher
+        return self.closed_captured + (prefetcher.captured if prefetcher is not None else 0)
+
+    @property
+    def dropped(self):
+        prefetcher = self.prefetcher
+        return self.closed_dropped + (prefetcher.dropped if prefetcher is not None else 0)
+
+    def __str__(self):
+        def ms(seconds):
+            return '-' if seconds is None else '{:.1f} ms'.format(seconds * 1000)
+
+        text = 'open -> {}, users -> {}, opens -> {}, closes -> {}, reused in grace -> {}, open latency -> {}, ' \
+               'first frame -> {}, close latency -> {}'.format(self.prefetcher is not None, self.users, self.opens,
+                                                               self.closes, self.reused, ms(self.open_latency),
+                                                               ms(self.first_frame_latency), ms(self.close_latency))
+        if self.prefetcher is not None:
+            text += ', {}'.format(self.prefetcher)
+        return text
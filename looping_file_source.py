@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# loopingfilesrc, a video file decoded and played in a loop without a gap, for launch strings, e.g.
+#   loopingfilesrc location=clip.mp4 ! videoscale ! video/x-raw,width=320,height=240 ! x264enc ! ...
+# multifilesrc loop=true only works for raw and elementary streams, a demuxer can't start over on the bytes of a
+# container
+import threading
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GObject, Gst
+
+
+class LoopingFileSource(Gst.Bin):
+    """filesrc ! decodebin ! videoconvert, looped with segment seeks.
+
+    A segment seek makes the demuxer end the file with a segment-done event instead of end of stream, and the
+    non flushing seek back to the start that answers it continues the running time where the file ended, so the
+    elements downstream never see the stream restart. The first one is sent on the first buffer, the few frames
+    decoded before it is handled play twice.
+    Seeks are sent from a thread of their own, the demuxer takes its stream lock to handle them.
+    """
+
+    __gstmetadata__ = ('Looping file source', 'Source/Video', 'Decodes a video file in a loop', 'gstreamer-examples')
+    __gsttemplates__ = (Gst.PadTemplate.new('src', Gst.PadDirection.SRC, Gst.PadPresence.ALWAYS,
+                                            Gst.Caps.from_string('video/x-raw')),)
+
+    def __init__(self):
+        super(LoopingFileSource, self).__init__()
+        self.source = Gst.ElementFactory.make('filesrc', 'file')
+        self.decoder = Gst.ElementFactory.make('decodebin', 'decoder')
+        self.converter = Gst.ElementFactory.make('videoconvert', 'converter')
+        for element in (self.source, self.decoder, self.converter):
+            self.add(element)
+        self.source.link(self.decoder)
+        self.decoder.connect('pad-added', self.on_pad_added)
+        self.add_pad(Gst.GhostPad.new_from_template('src', self.converter.get_static_pad('src'),
+                                                    self.get_pad_template('src')))
+        sink = self.converter.get_static_pad('sink')
+        sink.add_probe(Gst.PadProbeType.BUFFER, self.on_first_buffer)
+        sink.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_event)
+
+    @GObject.Property(type=str)
+    def location(self):
+        return self.source.get_property('location')
+
+    @location.setter
+    def location(self, value):
+        self.source.set_property('location', value)
+
+    def on_pad_added(self, decoder, pad):
+        sink = self.converter.get_static_pad('sink')
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        if not sink.is_linked() and caps.get_structure(0).get_name().startswith('video/'):
+            pad.link(sink)
+
+    def on_first_buffer(self, pad, info):
+        self.seek_start()
+        return Gst.PadProbeReturn.REMOVE
+
+    def on_event(self, pad, info):
+        if info.get_event().type != Gst.EventType.SEGMENT_DONE:
+            return Gst.PadProbeReturn.OK
+        self.seek_start()
+        return Gst.PadProbeReturn.DROP
+
+    def seek_start(self):
+        sink = self.converter.get_static_pad('sink')
+        event = Gst.Event.new_seek(1., Gst.Format.TIME, Gst.SeekFlags.SEGMENT, Gst.SeekType.SET, 0,
+                                   Gst.SeekType.SET, Gst.CLOCK_TIME_NONE)
+        thread = threading.Thread(target=sink.push_event, args=(event,))
+        thread.daemon = True
+        thread.start()
+
+
+def register():
+    # once Gst is initialized, before the first launch string naming loopingfilesrc is parsed
+    if Gst.ElementFactory.find('loopingfilesrc') is None:
+        Gst.Element.register(None, 'loopingfilesrc', Gst.Rank.NONE, LoopingFileSource)
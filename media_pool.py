@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Pre-built pipelines for non-shared mounts, so connecting clients don't pay for pipeline construction, and an SDP
+# cache per mount that saves building the SDP of every DESCRIBE answer
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+from gi.repository import Gst, GstRtspServer
+
+
+class ElementPool(Thread):
+    """Keeps size pipelines built by build() and brought to warm_state, refilled on its own thread.
+
+    do_create_element takes a warm pipeline instead of parsing one; when the pool is empty it builds one in place
+    and counts a miss. READY is as far as a pipeline can be warmed before it is handed to an RTSPMedia: the media
+    links the payloaders only when it prepares, and live sources do not preroll anyway. Use Gst.State.NULL for
+    sources that hold a device exclusively once opened.
+    """
+
+    def __init__(self, build, size=2, warm_state=Gst.State.READY):
+        super(ElementPool, self).__init__(daemon=True)
+        self.build = build
+        self.size = size
+        self.warm_state = warm_state
+        self.elements = deque()
+        self.condition = Condition()
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0
+        self.warm_total = 0.
+
+    def warm(self):
+        started = monotonic()
+        element = self.build()
+        if self.warm_state != Gst.State.NULL:
+            element.set_state(self.warm_state)
+            element.get_state(Gst.CLOCK_TIME_NONE)
+        elapsed = monotonic() - started
+        self.warmed += 1
+        self.warm_total += elapsed
+        return element
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or len(self.elements) < self.size)
+                if self.stopped:
+                    break
+            element = self.warm()
+            with self.condition:
+                self.elements.append(element)
+        self.clear()
+
+    def take(self):
+        with self.condition:
+            element = self.elements.popleft() if self.elements else None
+            self.condition.notify()
+        if element is None:
+            self.misses += 1
+            return self.build()
+        self.hits += 1
+        return element
+
+    def clear(self):
+        with self.condition:
+            elements, self.elements = list(self.elements), deque()
+        for element in elements:
+            element.set_state(Gst.State.NULL)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def __str__(self):
+        average = self.warm_total / self.warmed if self.warmed else 0.
+        return 'ready -> {}, hits -> {}, misses -> {}, warm time avg -> {:.1f} ms'.format(
+            len(self.elements), self.hits, self.misses, average * 1000)
+
+
+class SdpCache:
+    """SDP messages by mount path and server address, kept for max_age seconds.
+
+    Nothing watches the pipeline caps; a mount whose launch or caps change must be invalidated by its owner.
+    """
+
+    def __init__(self, max_age=30.):
+        self.max_age = max_age
+        self.lock = Lock()
+        self.messages = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.messages.get(key)
+            if entry is None or monotonic() - entry[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, sdp):
+        with self.lock:
+            self.messages[key] = (sdp, monotonic())
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.messages.clear()
+            else:
+                for key in [key for key in self.messages if key[0] == path]:
+                    del self.messages[key]
+
+    def __str__(self):
+        return 'mounts -> {}, hits -> {}, misses -> {}'.format(len(self.messages), self.hits, self.misses)
+
+
+class SdpCachingClient(GstRtspServer.RTSPClient):
+    """Answers DESCRIBE with the cached SDP of the mount when there is one.
+
+    Only the SDP is cached: the client looks the media up before it asks for the SDP, so every DESCRIBE still
+    constructs and prepares a media, and on a non-shared pooled mount takes a pipeline from the pool. The
+    pre_describe_request hook cannot answer in its place, any status it returns but OK is sent as an error.
+    """
+
+    def __init__(self, sdp_cache, **properties):
+        super(SdpCachingClient, self).__init__(**properties)
+        self.sdp_cache = sdp_cache
+
+    def cache_key(self):
+        ctx = GstRtspServer.RTSPContext.get_current()
+        if ctx is None or ctx.uri is None:
+            return None
+        # the origin and connection lines carry the address the client connected to
+        address = self.get_connection().get_read_socket().get_local_address().get_address().to_string()
+        return ctx.uri.abspath, address
+
+    def do_create_sdp(self, media):
+        key = self.cache_key()
+        sdp = self.sdp_cache.get(key) if key is not None else None
+        if sdp is None:
+            sdp = GstRtspServer.RTSPClient.do_create_sdp(self, media)
+            if sdp is not None and key is not None:
+                self.sdp_cache.put(key, sdp.copy()[1])
+            return sdp
+        # the client takes ownership of the message it gets
+        return sdp.copy()[1]
+
+
+def create_sdp_caching_client(server, sdp_cache):
+    """For a server's do_create_client, sets up the client the way the default implementation does."""
+    client = SdpCachingClient(sdp_cache)
+    client.set_session_pool(server.get_session_pool())
+    client.set_mount_points(server.get_mount_points())
+    client.set_auth(server.get_auth())
+    client.set_thread_pool(server.get_thread_pool())
+    return client
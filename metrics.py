@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# Metrics of the streaming hot path in the Prometheus text format, served over HTTP from the server process
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import monotonic
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(key, _escape(value))
+                                            for key, value in sorted(labels.items())))
+
+
+class MetricsRegistry:
+    """Counters and gauges kept in memory plus collectors, callables read at scrape time.
+
+    A collector returns (name, labels, value) tuples; it is how gauges such as appsrc levels or pool sizes are
+    exported without touching them on the streaming threads.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.kinds = {}
+        self.values = {}
+        self.collectors = {}
+        self.routes = {'/metrics': lambda: ('text/plain; version=0.0.4', self.render())}
+        self.server = None
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def remove(self, **labels):
+        # drops every series carrying all of the given labels, e.g. the ones of a media that went away
+        wanted = set(labels.items())
+        with self.lock:
+            for key in [key for key in self.values if wanted.issubset(key[1])]:
+                del self.values[key]
+
+    def add_route(self, path, handler):
+        # handler returns (content type, body text) for GET requests on path
+        self.routes[path] = handler
+
+    def add_collector(self, key, collect):
+        with self.lock:
+            self.collectors[key] = collect
+
+    def remove_collector(self, key):
+        with self.lock:
+            self.collectors.pop(key, None)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+            collectors = list(self.collectors.values())
+        samples = [(name, dict(labels), value) for (name, labels), value in values]
+        for collect in collectors:
+            samples.extend(collect())
+        return samples
+
+    def render(self):
+        by_family = {}
+        for name, labels, value in self.samples():
+            # histogram samples are grouped under the family they were described with
+            family = name.rsplit('_', 1)[0] if name.endswith(('_bucket', '_sum', '_count')) else name
+            family = family if self.kinds.get(family, ('',))[0] == 'histogram' else name
+            by_family.setdefault(family, []).append((name, labels, value))
+        lines = []
+        for family in sorted(by_family):
+            kind, text = self.kinds.get(family, ('untyped', ''))
+            if text:
+                lines.append('# HELP {} {}'.format(family, text))
+            lines.append('# TYPE {} {}'.format(family, kind))
+            for name, labels, value in by_family[family]:
+                lines.append('{} {}'.format(_series(name, labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=None, address=None):
+        # METRICS_PORT and METRICS_ADDRESS override the defaults, so several servers can run on one host; a port
+        # that is taken is logged and the server runs without metrics rather than failing to start
+        port = int(os.environ.get('METRICS_PORT', 9110)) if port is None else port
+        address = os.environ.get('METRICS_ADDRESS', '127.0.0.1') if address is None else address
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                handler = registry.routes.get(self.path.split('?')[0])
+                if handler is None:
+                    self.send_error(404)
+                    return
+                content_type, body = handler()
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((address, port), Handler)
+        except OSError as e:
+            print('metrics not served on {}:{} -> {}'.format(address, port, e))
+            return None
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        print('metrics on http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+        return self.server
+
+
+metrics = MetricsRegistry()
+metrics.describe('gst_appsrc_push_total', 'counter', 'Buffers pushed into an appsrc, by FlowReturn.')
+metrics.describe('gst_appsrc_level_bytes', 'gauge', 'Bytes queued in an appsrc.')
+metrics.describe('gst_appsrc_level_buffers', 'gauge', 'Buffers queued in an appsrc.')
+metrics.describe('gst_frames_dropped_total', 'counter', 'Frames dropped before reaching a pipeline.')
+metrics.describe('gst_encoded_frames_total', 'counter', 'Frames that went through an encoder.')
+metrics.describe('gst_encode_seconds_total', 'counter', 'Time buffers spent inside an encoder.')
+metrics.describe('gst_frame_lag_seconds', 'gauge', 'Age of the last pushed frame when it was pushed.')
+metrics.describe('gst_frame_conversions_total', 'counter', 'Frames converted to the pipeline format.')
+metrics.describe('gst_capture_frames_total', 'counter', 'Frames read from a capture device.')
+metrics.describe('gst_buffer_pool_dry_total', 'counter', 'Buffers allocated because the buffer pool was empty.')
+metrics.describe('gst_encoder_bitrate', 'gauge', 'Bitrate set on an encoder by the adaptive bitrate controller.')
+metrics.describe('gst_gop_cache_overflows_total', 'counter', 'GOPs too large for the GOP cache.')
+metrics.describe('gst_time_to_first_frame_seconds', 'gauge',
+                 'Average time from a client media configured to its first payloaded frame.')
+metrics.describe('gst_capture_to_push_seconds', 'gauge', 'Average time from a frame captured to it being taken.')
+metrics.describe('gst_capture_to_push_max_seconds', 'gauge', 'Longest time from a frame captured to it being taken.')
+metrics.describe('gst_capture_open', 'gauge', 'Whether a lazily opened capture is open.')
+metrics.describe('gst_capture_open_seconds', 'gauge', 'Time the last capture open took.')
+metrics.describe('gst_capture_first_frame_seconds', 'gauge', 'Time from the last capture open to its first frame.')
+metrics.describe('gst_capture_close_seconds', 'gauge', 'Time the last capture close took.')
+metrics.describe('gst_rtsp_thread_pool_max_threads', 'gauge', 'Maximum threads of the RTSP thread pool.')
+metrics.describe('gst_rtsp_session_pool_max_sessions', 'gauge', 'Maximum sessions of the RTSP session pool.')
+metrics.describe('gst_rtsp_session_pool_sessions', 'gauge', 'Sessions in the RTSP session pool.')
+
+
+class EncodeTimer:
+    """Time buffers spend inside one encoder, matched by pts between its sink and src pads."""
+
+    def __init__(self):
+        self.pending = {}
+        self.frames = 0
+        self.total = 0.
+        self.max = 0.
+        self.started = monotonic()
+
+    def attach(self, encoder):
+        encoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_sink_buffer)
+        encoder.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.on_src_buffer)
+
+    def on_sink_buffer(self, pad, info):
+        self.pending[info.get_buffer().pts] = monotonic()
+        if len(self.pending) > 256:
+            self.pending.clear()
+        return Gst.PadProbeReturn.OK
+
+    def on_src_buffer(self, pad, info):
+        entered = self.pending.pop(info.get_buffer().pts, None)
+        if entered is not None:
+            elapsed = monotonic() - entered
+            self.frames += 1
+            self.total += elapsed
+            self.max = max(self.max, elapsed)
+        return Gst.PadProbeReturn.OK
+
+    def collect(self, **labels):
+        return [('gst_encoded_frames_total', labels, self.frames), ('gst_encode_seconds_total', labels, self.total)]
+
+    def __str__(self):
+        average = self.total / self.frames if self.frames else 0.
+        fps = self.frames / (monotonic() - self.started)
+        return 'encoded -> {}, fps -> {:.1f}, encode time avg -> {:.1f} ms, max -> {:.1f} ms, ' \
+               'busy -> {:.0f} %'.format(self.frames, fps, average * 1000, self.max * 1000, average * fps * 100)
+
+
+class MediaMetrics:
+    """Push counters of one media, plus its appsrc level read when scraped and, given its encoder, the throughput.
+
+    Series are labelled with the factory and a media number and are removed once the media is unprepared.
+    """
+
+    _ids = count()
+
+    def __init__(self, factory, rtsp_media=None, appsrc=None, encoder=None, registry=metrics):
+        self.registry = registry
+        self.labels = {'factory': factory, 'media': str(next(MediaMetrics._ids))}
+        self.appsrc = appsrc
+        # current-level-buffers only exists since GStreamer 1.20
+        self.level_buffers = appsrc is not None and appsrc.find_property('current-level-buffers') is not None
+        self.encode_timer = None
+        if encoder is not None:
+            self.encode_timer = EncodeTimer()
+            self.encode_timer.attach(encoder)
+        registry.add_collector(self, self.collect)
+        if rtsp_media is not None:
+            rtsp_media.connect('unprepared', self.close)
+
+    def pushed(self, retval):
+        # a counter rather than a rate, rate(gst_appsrc_push_total[1m]) gives the push rate for every scraper
+        self.registry.inc('gst_appsrc_push_total', flow=retval.value_nick, **self.labels)
+
+    def dropped(self, frames=1, reason='stale'):
+        if frames > 0:
+            self.registry.inc('gst_frames_dropped_total', frames, reason=reason, **self.labels)
+
+    def collect(self):
+        samples = []
+        if self.appsrc is not None:
+            samples.append(('gst_appsrc_level_bytes', self.labels, self.appsrc.get_property('current-level-bytes')))
+        if self.level_buffers:
+            samples.append(('gst_appsrc_level_buffers', self.labels,
+                            self.appsrc.get_property('current-level-buffers')))
+        if self.encode_timer is not None:
+            samples.extend(self.encode_timer.collect(**self.labels))
+        return samples
+
+    def close(self, *args):
+        self.registry.remove_collector(self)
+        self.registry.remove(**self.labels)
+
+
+def add_server_metrics(server, registry=metrics):
+    """Thread and session pool gauges of an RTSPServer."""
+
+    def collect():
+        thread_pool = server.get_thread_pool()
+        session_pool = server.get_session_pool()
+        return [
+            ('gst_rtsp_thread_pool_max_threads', {}, thread_pool.get_max_threads()),
+            ('gst_rtsp_session_pool_max_sessions', {}, session_pool.get_max_sessions()),
+            ('gst_rtsp_session_pool_sessions', {}, session_pool.get_n_sessions()),
+        ]
+
+    registry.add_collector(server, collect)
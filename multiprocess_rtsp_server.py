@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Same as threading_rtsp_server.py, but the camera is read and converted in its own process and frames reach the
+# server through a shared memory ring, so neither side can stall the other on the GIL
+import sys
+from multiprocessing import Event, Process
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtspServer', '1.0')
+from gi.repository import Gst, GstRtspServer, GObject
+
+from frame_buffers import FrameBufferPool, push_frame
+from frame_mailbox import LatestFrameMailbox
+from metrics import MediaMetrics, add_server_metrics, metrics
+from shm_frames import SharedFrameReader, SharedFrameRing, capture_process
+
+
+class Context:
+    def __init__(self):
+        self._timestamp = 0
+        self._need_data = True
+        self._sequence = 0
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+
+    @property
+    def need_data(self):
+        return self._need_data
+
+    @need_data.setter
+    def need_data(self, value):
+        self._need_data = value
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    @sequence.setter
+    def sequence(self, value):
+        self._sequence = value
+
+    def __str__(self):
+        return 'timestamp -> {}, need_data -> {}, sequence -> {}'.format(self._timestamp, self._need_data,
+                                                                         self._sequence)
+
+
+class SensorFactory(GstRtspServer.RTSPMediaFactory):
+    def __init__(self, frames, width, height, **properties):
+        super(SensorFactory, self).__init__(**properties)
+        self.width = width
+        self.height = height
+        self.fps = 6.
+        self.bitrate = 256
+        self.buffer_frames = 3
+        self.use_buffer_pool = False
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
+        self.pool = None
+        self.frame_size = self.width * self.height * 3
+        self.buffer_size = self.frame_size * self.buffer_frames
+        self.key_int_max = 0
+        self.duration = int(1 / self.fps * Gst.SECOND)  # duration of a frame in nanoseconds
+        launch_string = '( appsrc name=source is-live=true format=GST_FORMAT_TIME blocksize={} ' \
+                        'caps=video/x-raw,format=I420,width={},height={},framerate={}/1 ' \
+                        '! x264enc name=encoder key-int-max={} speed-preset=ultrafast bitrate={} tune=zerolatency ' \
+                        '! rtph264pay config-interval=1 name=pay0 pt=96 )'.format(self.buffer_size, self.width,
+                                                                                  self.height, int(self.fps),
+                                                                                  self.key_int_max, self.bitrate)
+
+        print(launch_string)
+        self.set_launch(launch_string)
+        self.set_shared(True)
+        self.set_eos_shutdown(True)
+        self.set_latency(500)
+        self.frame_timeout = 1.
+        self.frames = frames
+        self.frame_lag = None
+
+    def on_need_data(self, src, lenght, context, media_metrics):
+        context.need_data = True
+        while context.need_data:
+            frame = self.frames.wait_newer(context.sequence, self.frame_timeout, lambda: not context.need_data)
+            if frame is None or not context.need_data:
+                continue
+            context.sequence = frame.sequence
+            self.frame_lag = self.frames.lag(frame)
+            retval = push_frame(src, frame.data, context.timestamp, self.duration, pool=self.pool)
+            context.timestamp += self.duration
+            media_metrics.pushed(retval)
+            if retval != Gst.FlowReturn.OK:
+                print(retval)
+                context.need_data = False
+        print('context -> {}'.format(context))
+
+    def on_enough_data(self, src, context):
+        context.need_data = False
+        self.frames.wake()
+
+    def on_unprepared(self, rtsp_media, context):
+        context.need_data = False
+        self.frames.wake()
+
+    def do_configure(self, rtsp_media):
+        ctx = Context()
+        rtsp_media.connect('unprepared', self.on_unprepared, ctx)
+        appsrc = rtsp_media.get_element().get_child_by_name('source')
+        if self.use_buffer_pool:
+            self.pool = FrameBufferPool(appsrc.get_property('caps'), self.buffer_frames)
+            rtsp_media.connect('unprepared', self.pool.close)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        appsrc.connect('need-data', self.on_need_data, ctx, media_metrics)
+        appsrc.connect('enough-data', self.on_enough_data, ctx)
+
+
+class GstServer(GstRtspServer.RTSPServer):
+    def __init__(self, reader, width, height, **properties):
+        super(GstServer, self).__init__(**properties)
+        self.reader = reader
+        self.factory = SensorFactory(reader.mailbox, width, height)
+        self.get_mount_points().add_factory("/stream", self.factory)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        metrics.serve()
+        self.attach(None)
+
+    def collect(self):
+        samples = [
+            ('gst_capture_frames_total', {}, self.reader.ring.sequence),
+            # frames the capture process wrote over before the reader got to them
+            ('gst_frames_dropped_total', {'reason': 'shared_ring'}, self.reader.missed),
+        ]
+        if self.factory.frame_lag is not None:
+            samples.append(('gst_frame_lag_seconds', {}, round(self.factory.frame_lag, 6)))
+        if self.factory.pool is not None:
+            samples.append(('gst_buffer_pool_dry_total', {}, self.factory.pool.dry))
+        return samples
+
+
+if __name__ == '__main__':
+    if sys.platform == 'darwin':
+        width, height = 1280, 720
+    else:
+        width, height = 640, 480
+
+    ring = SharedFrameRing(shape=(height * 3 // 2, width), slots=8, create=True)
+    stopped = Event()
+    capture = Process(target=capture_process, args=(ring.name, stopped), daemon=True)
+    capture.start()
+
+    reader = SharedFrameReader(ring, LatestFrameMailbox())
+    reader.start()
+
+    GObject.threads_init()
+    Gst.init(None)
+
+    server = GstServer(reader, width, height)
+
+    loop = GObject.MainLoop()
+    try:
+        loop.run()
+    finally:
+        stopped.set()
+        reader.stop()
+        capture.join(1)
+        reader.join(1)
+        ring.close()
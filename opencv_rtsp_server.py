@@ -1,30 +1,44 @@
 #!/usr/bin/env python3
-import json
 
-import cv2
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
-
-def get_pad_info(pad):
-    return {
-        'name': pad.name,
-        'is_linked': pad.is_linked(),
-        'is_blocking': pad.is_blocking(),
-        'is_blocked': pad.is_blocked(),
-    }
+from adaptive_bitrate import BitrateController, open_bitrate_log
+from colour_conversion import make_conversion_stage
+from frame_buffers import FrameBufferPool, push_frame
+from frame_sources import open_frame_source
+from latency_tracer import LatencyTracer
+from lazy_capture import LazyCapture
+from metrics import MediaMetrics, add_server_metrics, metrics
+from pipeline_snapshot import snapshots
 
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(SensorFactory, self).__init__(**properties)
-        self.cap = cv2.VideoCapture(0)
         self.number_frames = 0
         self.fps = 30
+        # opened by the first media, released a grace period after the last one
+        self.camera = LazyCapture(lambda: open_frame_source(1280, 720, self.fps), grace=5.)
         self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
+        self.frame_timeout = 1.
+        self.buffer_frames = 3
+        self.use_buffer_pool = False
+        # per element latency histograms on the metrics endpoint, costs a probe per element and buffer
+        self.trace_latency = False
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
+        self.pool = None
+        # the encoder bitrate follows the clients' RTCP receiver reports within these bounds, in kbit/s
+        # off by default, every media then appends its decisions to adaptive_bitrate.csv
+        self.adaptive_bitrate = False
+        self.bitrate = 2048
+        self.min_bitrate = 256
+        self.max_bitrate = 4096
+        self.bitrate_controller = None
         self.source = Gst.ElementFactory.make('appsrc', 'source')
         self.source.set_property('is-live', True)
         self.source.set_property('block', True)
@@ -54,75 +68,59 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         self.filter.link(self.encoder)
         self.encoder.link(self.payloader)
 
+        self.conversion = make_conversion_stage(1280, 720, 'videoconvert')
         self.launch_string = 'appsrc name=source is-live=true block=true format=GST_FORMAT_TIME ' \
-                             'caps=video/x-raw,format=BGR,width=1280,height=720,framerate={}/1 ' \
-                             '! videoconvert ! capsfilter caps=video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=ultrafast tune=zerolatency ' \
-                             '! rtph264pay config-interval=1 name=pay0 pt=96'.format(self.fps)
+                             'caps=video/x-raw,format={},width=1280,height=720,framerate={}/1 ' \
+                             '! {}x264enc name=encoder speed-preset=ultrafast tune=zerolatency ' \
+                             '! rtph264pay config-interval=1 name=pay0 pt=96'.format(self.conversion.input_format,
+                                                                                     self.fps,
+                                                                                     self.conversion.launch_fragment())
         self.set_eos_shutdown(True)
         print('is_eos_shutdown {}'.format(self.is_eos_shutdown()))
 
-    def on_need_data(self, src, lenght):
-        if self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
-                data = frame.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
-                timestamp = self.number_frames * self.duration
-                buf.pts = buf.dts = int(timestamp)
-                buf.offset = timestamp
-                self.number_frames += 1
-                retval = src.emit('push-buffer', buf)
-                # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
-                #                                                                        self.duration,
-                #                                                                        self.duration / Gst.SECOND))
-                if retval != Gst.FlowReturn.OK:
-                    print(retval)
+    def on_need_data(self, src, lenght, media_metrics=None):
+        # appsrc only asks again once something was pushed, so wait until the camera has a frame
+        frame = None
+        while frame is None and self.camera.running:
+            frame = self.camera.get(self.frame_timeout)
+        if frame is not None:
+            timestamp = self.number_frames * self.duration
+            self.number_frames += 1
+            retval = push_frame(src, self.conversion(frame), timestamp, self.duration, offset=timestamp,
+                                pool=self.pool)
+            # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
+            #                                                                        self.duration,
+            #                                                                        self.duration / Gst.SECOND))
+            if media_metrics is not None:
+                media_metrics.pushed(retval)
+            if retval != Gst.FlowReturn.OK:
+                print(retval)
 
     def do_create_element(self, url):
         # return self.pipeline
-        response = dict()
-        pipeline = Gst.parse_launch(self.launch_string)
-
-        response['pipeline'] = {
-            'pads': {
-                pad.name: get_pad_info(pad) for pad in pipeline.pads
-            }
-        }
-
-        clock = pipeline.clock
-        if clock:
-            response['pipeline']['clock'] = {
-                'time': clock.get_time(),
-                'resolution': clock.get_resolution(),
-                'timeout': clock.get_timeout(),
-                'internal time': clock.get_internal_time(),
-                'floating': clock.is_floating(),
-                'synced': clock.is_synced(),
-                'name': clock.get_name(),
-                'calibration': clock.get_calibration()
-            }
-
-        response['elements'] = [
-            {
-                'name': child.name,
-                'state': child.current_state.value_nick,
-                'flags': child.flags,
-                'pads': {
-                    pad.name: get_pad_info(pad) for pad in child.pads
-                }
-            }
-            for child in pipeline.children]
-
-        print(json.dumps(response, indent=4))
-        return pipeline
+        return Gst.parse_launch(self.launch_string)
 
     def do_configure(self, rtsp_media):
         self.number_frames = 0
+        self.camera.attach(rtsp_media)
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data)
+        if self.use_buffer_pool:
+            self.pool = FrameBufferPool(appsrc.get_property('caps'), self.buffer_frames)
+            rtsp_media.connect('unprepared', self.pool.close)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        if self.trace_latency:
+            LatencyTracer(appsrc, media_metrics.labels, rtsp_media)
+        # introspected only when /pipelines is requested or on SIGUSR1
+        snapshots.track('sensor/{}'.format(media_metrics.labels['media']), rtsp_media.get_element(), rtsp_media)
+        if self.adaptive_bitrate:
+            self.bitrate_controller = BitrateController(encoder, self.min_bitrate, self.max_bitrate,
+                                                        initial=self.bitrate, log=open_bitrate_log(),
+                                                        close_log=True)
+            self.bitrate_controller.add_media(rtsp_media)
+            rtsp_media.connect('unprepared', self.bitrate_controller.stop)
+            self.bitrate_controller.start()
+        appsrc.connect('need-data', self.on_need_data, media_metrics)
 
 
 class GstServer(GstRtspServer.RTSPServer):
@@ -132,17 +130,26 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory.set_shared(True)
         self.get_mount_points().add_factory("/stream", self.factory)
         GObject.timeout_add_seconds(60, self.clean_pools)
-        GObject.timeout_add_seconds(3, self.check_health)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        snapshots.serve(metrics)
+        snapshots.print_on_signal()
+        metrics.serve()
         self.attach(None)
 
-    def check_health(self):
-        thread_pool = self.get_thread_pool()
-        session_pool = self.get_session_pool()
-        print('thread_pool: max_threads {}'.format(thread_pool.get_max_threads()))
-        print('session_pool: max_sessions {}, n_sessions {}'.format(session_pool.get_max_sessions(),
-                                                                    session_pool.get_n_sessions()))
-
-        return True
+    def collect(self):
+        camera = self.factory.camera
+        samples = [
+            ('gst_capture_frames_total', {}, camera.captured),
+            # frames the prefetcher replaced before any media took them
+            ('gst_frames_dropped_total', {'reason': 'capture'}, camera.dropped),
+        ]
+        samples.extend(camera.collect())
+        if self.factory.pool is not None:
+            samples.append(('gst_buffer_pool_dry_total', {}, self.factory.pool.dry))
+        if self.factory.bitrate_controller is not None:
+            samples.append(('gst_encoder_bitrate', {}, int(self.factory.bitrate_controller.bitrate)))
+        return samples
 
     def clean_pools(self):
         clean_count = self.get_session_pool().cleanup()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# On demand snapshots of pipeline elements, pads and clock, cached until an element changes state
+import json
+import signal
+from threading import Lock
+from time import time
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+
+def get_pad_info(pad):
+    return {
+        'name': pad.name,
+        'is_linked': pad.is_linked(),
+        'is_blocking': pad.is_blocking(),
+        'is_blocked': pad.is_blocked(),
+    }
+
+
+def get_clock_info(clock):
+    return {
+        'time': clock.get_time(),
+        'resolution': clock.get_resolution(),
+        'timeout': clock.get_timeout(),
+        'internal time': clock.get_internal_time(),
+        'floating': clock.is_floating(),
+        'synced': clock.is_synced(),
+        'name': clock.get_name(),
+        'calibration': clock.get_calibration()
+    }
+
+
+def take_snapshot(pipeline):
+    response = {
+        'taken': time(),
+        'pipeline': {
+            'name': pipeline.name,
+            'pads': {
+                pad.name: get_pad_info(pad) for pad in pipeline.pads
+            }
+        }
+    }
+
+    clock = pipeline.get_clock()
+    if clock:
+        response['pipeline']['clock'] = get_clock_info(clock)
+
+    response['elements'] = [
+        {
+            'name': child.name,
+            'state': child.current_state.value_nick,
+            'flags': int(child.flags),
+            'pads': {
+                pad.name: get_pad_info(pad) for pad in child.pads
+            }
+        }
+        for child in pipeline.children]
+    return response
+
+
+class PipelineSnapshots:
+    """Pipelines tracked by name, snapshotted only when asked and only again after a state change.
+
+    Tracking costs a state change handler; nothing is walked on the client connect path. The element of an RTSP
+    media is a child of the media pipeline, whose bin drops the child bus messages, so with rtsp_media the snapshot
+    is invalidated on the media new-state signal instead of a sync-message handler on the pipeline bus.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pipelines = {}
+        self.cache = {}
+        # object and handler id of every tracked pipeline, disconnected when it is untracked
+        self.handlers = {}
+        self.taken = 0
+        self.served = 0
+
+    def track(self, name, pipeline, rtsp_media=None):
+        self.untrack(name)
+        handler = None
+        if rtsp_media is not None:
+            handler = (rtsp_media, rtsp_media.connect('new-state', self.on_state_changed, name))
+        else:
+            bus = pipeline.get_bus()
+            if bus is not None:
+                bus.enable_sync_message_emission()
+                handler = (bus, bus.connect('sync-message::state-changed', self.on_state_changed, name))
+        with self.lock:
+            self.pipelines[name] = pipeline
+            self.cache.pop(name, None)
+            if handler is not None:
+                self.handlers[name] = handler
+        if rtsp_media is not None:
+            rtsp_media.connect('unprepared', lambda *args: self.untrack(name))
+
+    def untrack(self, name):
+        with self.lock:
+            self.pipelines.pop(name, None)
+            self.cache.pop(name, None)
+            handler = self.handlers.pop(name, None)
+        if handler is not None:
+            instance, handler_id = handler
+            instance.disconnect(handler_id)
+            if isinstance(instance, Gst.Bus):
+                instance.disable_sync_message_emission()
+
+    def on_state_changed(self, instance, message_or_state, name):
+        with self.lock:
+            self.cache.pop(name, None)
+
+    def snapshot(self, name):
+        with self.lock:
+            pipeline = self.pipelines.get(name)
+            cached = self.cache.get(name)
+        if pipeline is None:
+            return None
+        self.served += 1
+        if cached is None:
+            cached = take_snapshot(pipeline)
+            self.taken += 1
+            with self.lock:
+                if name in self.pipelines:
+                    self.cache[name] = cached
+        return cached
+
+    def snapshots(self):
+        with self.lock:
+            names = list(self.pipelines)
+        return {name: self.snapshot(name) for name in names}
+
+    def to_json(self):
+        return json.dumps(self.snapshots(), indent=4)
+
+    def serve(self, registry, path='/pipelines'):
+        registry.add_route(path, lambda: ('application/json', self.to_json()))
+
+    def print_on_signal(self, signum=signal.SIGUSR1):
+        def on_signal():
+            print(self.to_json())
+            return GLib.SOURCE_CONTINUE
+
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, on_signal)
+
+    def __str__(self):
+        return 'pipelines -> {}, cached -> {}, taken -> {}, served -> {}'.format(len(self.pipelines), len(self.cache),
+                                                                                 self.taken, self.served)
+
+
+snapshots = PipelineSnapshots()
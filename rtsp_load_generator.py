@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Opens N concurrent RTSP clients against a local server, adding them one by one, and reports for every client count
+# the connect latency and time to first frame of the newest client, the received fps and inter-frame jitter over all
+# clients and the server CPU usage, e.g.
+#   python3 rtsp_load_generator.py --clients 20 --ramp 5 --transport tcp rtsp://127.0.0.1:8554/stream
+import argparse
+import ipaddress
+import os
+import statistics
+import sys
+from time import monotonic
+from urllib.parse import urlsplit
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, GObject, Gst
+
+
+class LoadClient:
+    """One rtspsrc ! parsebin ! fakesink client; frames are counted after the parser, nothing is decoded."""
+
+    def __init__(self, url, transport, latency=0):
+        self.url = url
+        self.pipeline = Gst.parse_launch('rtspsrc name=src location={} protocols={} latency={} ! parsebin '
+                                         '! fakesink name=sink sync=false signal-handoffs=true'.format(url, transport,
+                                                                                                      latency))
+        self.pipeline.get_by_name('src').connect('pad-added', self.on_pad_added)
+        self.pipeline.get_by_name('sink').connect('handoff', self.on_handoff)
+        self.pipeline.get_bus().add_signal_watch()
+        self.pipeline.get_bus().connect('message::error', self.on_error)
+        self.started = None
+        self.connected = None
+        self.first_frame = None
+        self.last_frame = None
+        self.frames = 0
+        self.window_frames = 0
+        self.intervals = []
+        self.errors = 0
+
+    def start(self):
+        self.started = monotonic()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+    def on_pad_added(self, src, pad):
+        # rtspsrc exposes its pads once SETUP and PLAY went through
+        if self.connected is None:
+            self.connected = monotonic()
+
+    def on_handoff(self, sink, buf, pad):
+        now = monotonic()
+        if self.first_frame is None:
+            self.first_frame = now
+        elif self.last_frame is not None:
+            self.intervals.append(now - self.last_frame)
+        self.last_frame = now
+        self.frames += 1
+        self.window_frames += 1
+
+    def on_error(self, bus, message):
+        self.errors += 1
+        print('client {} error -> {}'.format(self.url, message.parse_error().debug))
+
+    @property
+    def connect_latency(self):
+        return None if self.connected is None else self.connected - self.started
+
+    @property
+    def time_to_first_frame(self):
+        return None if self.first_frame is None else self.first_frame - self.started
+
+    def take_window(self):
+        frames, intervals = self.window_frames, self.intervals
+        self.window_frames, self.intervals = 0, []
+        return frames, intervals
+
+
+class ProcessCpu:
+    """CPU usage of a process from /proc/<pid>/stat, in percent of one core between two samples."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.last = self.sample()
+
+    def sample(self):
+        try:
+            with open('/proc/{}/stat'.format(self.pid)) as stat:
+                # the command name may contain spaces, the fields after it are fixed
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return monotonic(), (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def percent(self):
+        current = self.sample()
+        last, self.last = self.last, current
+        if current is None or last is None or current[0] <= last[0]:
+            return None
+        return (current[1] - last[1]) / (current[0] - last[0]) * 100
+
+
+def find_server_pid(match):
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open('/proc/{}/cmdline'.format(entry), 'rb') as cmdline:
+                arguments = cmdline.read().split(b'\0')
+        except OSError:
+            continue
+        if any(match.encode() in argument for argument in arguments[1:]):
+            return int(entry)
+    return None
+
+
+def check_local(url):
+    host = urlsplit(url).hostname
+    if host == 'localhost':
+        return
+    try:
+        if ipaddress.ip_address(host).is_loopback:
+            return
+    except ValueError:
+        pass
+    raise SystemExit('{} is not a local address, the load generator only runs against localhost'.format(host))
+
+
+class LoadGenerator:
+    def __init__(self, urls, clients, ramp, transport, cpu=None, csv=None):
+        self.urls = urls
+        self.clients = clients
+        self.ramp = ramp
+        self.transport = transport
+        self.cpu = cpu
+        self.csv = csv
+        self.running = []
+        self.loop = GObject.MainLoop()
+
+    def start(self):
+        if self.csv is not None:
+            self.csv.write('clients,connect_ms,ttff_ms,fps_avg,fps_min,jitter_ms,max_gap_ms,server_cpu\n')
+        self.add_client()
+        GLib.timeout_add(int(self.ramp * 1000), self.step)
+        self.loop.run()
+
+    def add_client(self):
+        client = LoadClient(self.urls[len(self.running) % len(self.urls)], self.transport)
+        self.running.append(client)
+        client.start()
+
+    def step(self):
+        self.report()
+        if len(self.running) >= self.clients:
+            for client in self.running:
+                client.stop()
+            self.loop.quit()
+            return False
+        self.add_client()
+        return True
+
+    def report(self):
+        newest = self.running[-1]
+        fps, intervals = [], []
+        for client in self.running:
+            frames, window = client.take_window()
+            fps.append(frames / self.ramp)
+            intervals.extend(window)
+        jitter = statistics.pstdev(intervals) if len(intervals) > 1 else 0.
+        max_gap = max(intervals) if intervals else 0.
+        cpu = self.cpu.percent() if self.cpu is not None else None
+
+        def ms(seconds):
+            return '-' if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+        print('clients -> {}, connect -> {} ms, first frame -> {} ms, fps avg -> {:.1f}, min -> {:.1f}, '
+              'jitter -> {:.1f} ms, max gap -> {:.1f} ms, server cpu -> {}'.format(
+                  len(self.running), ms(newest.connect_latency), ms(newest.time_to_first_frame),
+                  statistics.mean(fps), min(fps), jitter * 1000, max_gap * 1000,
+                  '-' if cpu is None else '{:.0f} %'.format(cpu)))
+        if self.csv is not None:
+            self.csv.write('{},{},{},{:.2f},{:.2f},{:.2f},{:.2f},{}\n'.format(
+                len(self.running), ms(newest.connect_latency).strip('-'), ms(newest.time_to_first_frame).strip('-'),
+                statistics.mean(fps), min(fps), jitter * 1000, max_gap * 1000, '' if cpu is None else '{:.1f}'.format(cpu)))
+            self.csv.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RTSP load generator for a local server')
+    parser.add_argument('urls', nargs='*', default=['rtsp://127.0.0.1:8554/stream'],
+                        help='mounts to connect to, clients are spread over them in turn')
+    parser.add_argument('--clients', type=int, default=10, help='clients opened in total')
+    parser.add_argument('--ramp', type=float, default=5., help='seconds between two clients, also the report window')
+    parser.add_argument('--transport', choices=('tcp', 'udp'), default='tcp')
+    parser.add_argument('--server-pid', type=int, help='server process, found by --server-match when missing')
+    parser.add_argument('--server-match', default='rtsp_server',
+                        help='substring of the server command line used to find its process')
+    parser.add_argument('--csv', help='also write the reports to this csv file')
+    args = parser.parse_args()
+
+    for url in args.urls:
+        check_local(url)
+    Gst.init(None)
+    pid = args.server_pid or find_server_pid(args.server_match)
+    if pid is None:
+        print('server process not found, cpu is not reported', file=sys.stderr)
+    csv = open(args.csv, 'w') if args.csv else None
+    LoadGenerator(args.urls, args.clients, args.ramp, args.transport, ProcessCpu(pid) if pid else None, csv).start()
+
+
+if __name__ == '__main__':
+    main()
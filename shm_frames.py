@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Shared memory frame ring between a capture process and the RTSP server process
+from multiprocessing import shared_memory
+from threading import Event, Thread
+from time import monotonic_ns
+
+import cv2
+import numpy as np
+
+from frame_sources import open_frame_source
+
+HEADER_FIELDS = 8  # sequence, slots, ndim, shape (up to 3 dims), unused
+SLOT_FIELDS = 2  # sequence, capture timestamp in monotonic nanoseconds
+
+
+class SharedFrameRing:
+    """Ring of fixed size frames in a multiprocessing shared memory block.
+
+    One process writes, any number of processes read. Each slot carries the sequence number of the frame it holds,
+    readers check it before and after copying a frame out so a slot overwritten meanwhile is never returned.
+    """
+
+    def __init__(self, name=None, shape=None, slots=8, create=False):
+        if create:
+            frame_bytes = int(np.prod(shape))
+            size = (HEADER_FIELDS + SLOT_FIELDS * slots) * 8 + frame_bytes * slots
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.header = np.ndarray((HEADER_FIELDS,), np.int64, buffer=self.shm.buf)
+            self.header[:] = 0
+            self.header[1] = slots
+            self.header[2] = len(shape)
+            self.header[3:3 + len(shape)] = shape
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.header = np.ndarray((HEADER_FIELDS,), np.int64, buffer=self.shm.buf)
+            slots = int(self.header[1])
+            shape = tuple(int(d) for d in self.header[3:3 + int(self.header[2])])
+
+        self.name = self.shm.name
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.owner = create
+        offset = HEADER_FIELDS * 8
+        self.meta = np.ndarray((slots, SLOT_FIELDS), np.int64, buffer=self.shm.buf, offset=offset)
+        offset += SLOT_FIELDS * slots * 8
+        self.frames = np.ndarray((slots,) + self.shape, np.uint8, buffer=self.shm.buf, offset=offset)
+        if create:
+            self.meta[:] = 0
+
+    @property
+    def sequence(self):
+        return int(self.header[0])
+
+    def write(self, frame, timestamp=None):
+        sequence = int(self.header[0]) + 1
+        slot = sequence % self.slots
+        self.meta[slot, 0] = -1  # mark the slot as being written
+        np.copyto(self.frames[slot], frame)
+        self.meta[slot, 1] = monotonic_ns() if timestamp is None else timestamp
+        self.meta[slot, 0] = sequence
+        self.header[0] = sequence
+        return sequence
+
+    def read_newer(self, sequence):
+        # returns (sequence, timestamp in ns, private copy of the frame), or None when nothing newer is readable
+        latest = int(self.header[0])
+        if latest <= sequence:
+            return None
+        slot = latest % self.slots
+        if self.meta[slot, 0] != latest:
+            return None
+        frame = self.frames[slot].copy()
+        timestamp = int(self.meta[slot, 1])
+        if self.meta[slot, 0] != latest:
+            return None
+        return latest, timestamp, frame
+
+    def close(self):
+        # drop the numpy views before closing the mapping
+        self.header = self.meta = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedFrameReader(Thread):
+    """Polls a SharedFrameRing and publishes new frames into a LatestFrameMailbox."""
+
+    def __init__(self, ring, mailbox, interval=0.005):
+        super(SharedFrameReader, self).__init__(daemon=True)
+        self.ring = ring
+        self.mailbox = mailbox
+        self.interval = interval
+        self.stopped = Event()
+        self.sequence = 0
+        self.missed = 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            result = self.ring.read_newer(self.sequence)
+            if result is None:
+                continue
+            sequence, timestamp, frame = result
+            if self.sequence and sequence > self.sequence + 1:
+                self.missed += sequence - self.sequence - 1
+            self.sequence = sequence
+            self.mailbox.publish(frame, timestamp / 1e9)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def capture_process(name, stopped, spec=None, fps=30., convert=cv2.COLOR_BGR2YUV_I420):
+    """Entry point of the capture process: read the frame source, convert and write into the ring called name.
+
+    spec picks the source like FRAME_SOURCE does, see frame_sources.
+    """
+    ring = SharedFrameRing(name)
+    if convert == cv2.COLOR_BGR2YUV_I420:
+        height, width = ring.shape[0] * 2 // 3, ring.shape[1]
+    else:
+        height, width = ring.shape[:2]
+    cap = open_frame_source(width, height, fps, spec)
+    print('capture process: cap.isOpened() -> {}'.format(cap.isOpened()))
+    try:
+        while cap.isOpened() and not stopped.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            timestamp = monotonic_ns()
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            if convert is not None:
+                frame = cv2.cvtColor(frame, convert)
+            ring.write(frame, timestamp)
+    finally:
+        cap.release()
+        ring.close()
@@ -1,31 +1,30 @@
 #!/usr/bin/env python3
-import json
-from threading import Thread, current_thread
-
-import cv2
+# Server under test for rtsp_load_generator.py, e.g.
+#   python3 rtsp_load_generator.py --clients 20 --server-match stress_opencv_rtsp_server rtsp://127.0.0.1:8554/stream
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
-
-def get_pad_info(pad):
-    return {
-        'name': pad.name,
-        'is_linked': pad.is_linked(),
-        'is_blocking': pad.is_blocking(),
-        'is_blocked': pad.is_blocked(),
-    }
+from frame_buffers import push_frame
+from frame_sources import open_frame_source
+from lazy_capture import LazyCapture
+from metrics import MediaMetrics, add_server_metrics, metrics
+from pipeline_snapshot import snapshots
 
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(SensorFactory, self).__init__(**properties)
-        self.cap = cv2.VideoCapture(0)
+        self.frame_timeout = 1.
         self.number_frames = 0
         self.fps = 30
+        # opened by the first media, released a grace period after the last one
+        self.camera = LazyCapture(lambda: open_frame_source(1280, 720, self.fps), grace=5.)
         self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
         self.source = Gst.ElementFactory.make('appsrc', 'source')
         self.source.set_property('is-live', True)
         self.source.set_property('block', True)
@@ -58,72 +57,41 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         self.launch_string = 'appsrc name=source is-live=true block=true format=GST_FORMAT_TIME ' \
                              'caps=video/x-raw,format=BGR,width=1280,height=720,framerate={}/1 ' \
                              '! videoconvert ! capsfilter caps=video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=ultrafast tune=zerolatency ' \
+                             '! x264enc name=encoder speed-preset=ultrafast tune=zerolatency ' \
                              '! rtph264pay config-interval=1 name=pay0 pt=96'.format(self.fps)
         self.set_eos_shutdown(True)
         print('is_eos_shutdown {}'.format(self.is_eos_shutdown()))
 
-    def on_need_data(self, src, lenght):
-        if self.cap.isOpened():
-            ret, frame = self.cap.read()
-            if ret:
-                data = frame.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
-                timestamp = self.number_frames * self.duration
-                buf.pts = buf.dts = int(timestamp)
-                buf.offset = timestamp
-                self.number_frames += 1
-                retval = src.emit('push-buffer', buf)
-                # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
-                #                                                                        self.duration,
-                #                                                                        self.duration / Gst.SECOND))
-                if retval != Gst.FlowReturn.OK:
-                    print(retval)
+    def on_need_data(self, src, lenght, media_metrics=None):
+        # appsrc only asks again once something was pushed, so wait until the camera has a frame
+        frame = None
+        while frame is None and self.camera.running:
+            frame = self.camera.get(self.frame_timeout)
+        if frame is not None:
+            timestamp = self.number_frames * self.duration
+            self.number_frames += 1
+            retval = push_frame(src, frame, timestamp, self.duration, offset=timestamp)
+            if media_metrics is not None:
+                media_metrics.pushed(retval)
+            # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
+            #                                                                        self.duration,
+            #                                                                        self.duration / Gst.SECOND))
+            if retval != Gst.FlowReturn.OK:
+                print(retval)
 
     def do_create_element(self, url):
         # return self.pipeline
-        response = dict()
-        pipeline = Gst.parse_launch(self.launch_string)
-
-        response['pipeline'] = {
-            'pads': {
-                pad.name: get_pad_info(pad) for pad in pipeline.pads
-            }
-        }
-
-        clock = pipeline.clock
-        if clock:
-            response['pipeline']['clock'] = {
-                'time': clock.get_time(),
-                'resolution': clock.get_resolution(),
-                'timeout': clock.get_timeout(),
-                'internal time': clock.get_internal_time(),
-                'floating': clock.is_floating(),
-                'synced': clock.is_synced(),
-                'name': clock.get_name(),
-                'calibration': clock.get_calibration()
-            }
-
-        response['elements'] = [
-            {
-                'name': child.name,
-                'state': child.current_state.value_nick,
-                'flags': child.flags,
-                'pads': {
-                    pad.name: get_pad_info(pad) for pad in child.pads
-                }
-            }
-            for child in pipeline.children]
-
-        print(json.dumps(response, indent=4))
-        return pipeline
+        return Gst.parse_launch(self.launch_string)
 
     def do_configure(self, rtsp_media):
         self.number_frames = 0
+        self.camera.attach(rtsp_media)
+        # introspected only on SIGUSR1
+        snapshots.track('sensor/{}'.format(id(rtsp_media)), rtsp_media.get_element(), rtsp_media)
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        appsrc.connect('need-data', self.on_need_data, media_metrics)
 
 
 class GstServer(GstRtspServer.RTSPServer):
@@ -133,17 +101,21 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory.set_shared(True)
         self.get_mount_points().add_factory("/stream", self.factory)
         GObject.timeout_add_seconds(60, self.clean_pools)
-        GObject.timeout_add_seconds(3, self.check_health)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        metrics.serve()
+        snapshots.print_on_signal()
         self.attach(None)
 
-    def check_health(self):
-        thread_pool = self.get_thread_pool()
-        session_pool = self.get_session_pool()
-        print('thread_pool: max_threads {}'.format(thread_pool.get_max_threads()))
-        print('session_pool: max_sessions {}, n_sessions {}'.format(session_pool.get_max_sessions(),
-                                                                    session_pool.get_n_sessions()))
-
-        return True
+    def collect(self):
+        camera = self.factory.camera
+        samples = [
+            ('gst_capture_frames_total', {}, camera.captured),
+            # frames the prefetcher replaced before any media took them
+            ('gst_frames_dropped_total', {'reason': 'capture'}, camera.dropped),
+        ]
+        samples.extend(camera.collect())
+        return samples
 
     def clean_pools(self):
         clean_count = self.get_session_pool().cleanup()
@@ -155,21 +127,9 @@ class GstServer(GstRtspServer.RTSPServer):
         return True
 
 
-def infinite_loop():
-    current_thread()
-    print('started stress thread')
-    while True:
-        pass
-
-
 Gst.init(None)
 
 server = GstServer()
 
-thread_count = 10
-stress_thread_pool = [Thread(target=infinite_loop) for _ in range(thread_count)]
-for  t in stress_thread_pool:
-    t.start()
-
 loop = GObject.MainLoop()
 loop.run()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 from threading import current_thread
 
-import cv2
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_buffers import push_frame
+from frame_sources import open_frame_source
+from lazy_capture import LazyCapture
+from metrics import MediaMetrics, add_server_metrics, metrics
+
 
 class Context:
     def __init__(self):
@@ -37,44 +41,46 @@ class Context:
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(SensorFactory, self).__init__(**properties)
-        self.cap = cv2.VideoCapture(0)
+        self.frame_timeout = 1.
         self.width = 1280
         self.height = 720
         self.buffer_size = self.width * self.height * 3
         self.fps = 30
+        # opened by the first media, released a grace period after the last one
+        self.camera = LazyCapture(lambda: open_frame_source(self.width, self.height, self.fps), grace=5.)
         self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
         self.launch_string = 'appsrc name=source is-live=true format=GST_FORMAT_TIME blocksize={} ' \
                              'caps=video/x-raw,format=BGR,width={},height={},framerate={}/1 ' \
                              '! videoconvert ! capsfilter caps=video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=ultrafast tune=zerolatency ' \
+                             '! x264enc name=encoder speed-preset=ultrafast tune=zerolatency ' \
                              '! rtph264pay config-interval=1 name=pay0 pt=96'.format(self.buffer_size, self.width,
                                                                                      self.height, self.fps)
         self.set_eos_shutdown(True)
         print('is_eos_shutdown {}'.format(self.is_eos_shutdown()))
 
-    def on_need_data(self, src, lenght, context):
+    def on_need_data(self, src, lenght, context, media_metrics):
         print('context address -> {}'.format(id(context)))
         print('need_data lenght -> {}, context -> {}'.format(lenght, context))
         context.need_data = True
         while context.need_data:
-            if self.cap.isOpened():
-                ret, frame = self.cap.read()
-                if ret:
-                    data = frame.tostring()
-                    buf = Gst.Buffer.new_allocate(None, len(data), None)
-                    buf.fill(0, data)
-                    buf.duration = self.duration
-                    buf.pts = context.timestamp
-                    context.timestamp += buf.duration
-                    retval = src.emit('push-buffer', buf)
-                    # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
-                    #                                                                        self.duration,
-                    #                                                                        self.duration / Gst.SECOND))
-                    print(retval)
-                    if retval != Gst.FlowReturn.OK:
-                        # client has disconnected, I suppose
-                        print(retval)
-                        context.need_data = False
+            frame = self.camera.get(self.frame_timeout)
+            if frame is None:
+                if not self.camera.running:
+                    context.need_data = False
+                continue
+            retval = push_frame(src, frame, context.timestamp, self.duration)
+            context.timestamp += self.duration
+            media_metrics.pushed(retval)
+            # print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
+            #                                                                        self.duration,
+            #                                                                        self.duration / Gst.SECOND))
+            print(retval)
+            if retval != Gst.FlowReturn.OK:
+                # client has disconnected, I suppose
+                print(retval)
+                context.need_data = False
         print('context -> {}'.format(context))
 
     def on_enough_data(self, src, context):
@@ -87,8 +93,11 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
 
     def do_configure(self, rtsp_media):
         ctx = Context()
+        self.camera.attach(rtsp_media)
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data, ctx)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        appsrc.connect('need-data', self.on_need_data, ctx, media_metrics)
         appsrc.connect('enough-data', self.on_enough_data, ctx)
 
 
@@ -99,17 +108,20 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory.set_shared(True)
         self.get_mount_points().add_factory("/stream", self.factory)
         GObject.timeout_add_seconds(60, self.clean_pools)
-        GObject.timeout_add_seconds(3, self.check_health)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        metrics.serve()
         self.attach(None)
 
-    def check_health(self):
-        thread_pool = self.get_thread_pool()
-        session_pool = self.get_session_pool()
-        print('thread_pool: max_threads {}'.format(thread_pool.get_max_threads()))
-        print('session_pool: max_sessions {}, n_sessions {}'.format(session_pool.get_max_sessions(),
-                                                                    session_pool.get_n_sessions()))
-
-        return True
+    def collect(self):
+        camera = self.factory.camera
+        samples = [
+            ('gst_capture_frames_total', {}, camera.captured),
+            # frames the prefetcher replaced before any media took them
+            ('gst_frames_dropped_total', {'reason': 'capture'}, camera.dropped),
+        ]
+        samples.extend(camera.collect())
+        return samples
 
     def clean_pools(self):
         clean_count = self.get_session_pool().cleanup()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Synthetic mono S16 audio with a click or chirp marker on a fixed period, generated chunk by chunk with numpy,
+# e.g. python3 synthetic_audio.py chirp 0.02 to time the generator for a marker and a chunk length in seconds
+import sys
+from time import perf_counter
+
+import numpy as np
+
+
+def marker_wave(kind, rate, amplitude=.8):
+    """One marker as int16 samples: a 1 ms click or a 50 ms 1 to 8 kHz chirp under a Hann window."""
+    if kind == 'click':
+        wave = np.ones(max(1, rate // 1000))
+    elif kind == 'chirp':
+        length = rate // 20
+        t = np.arange(length) / rate
+        duration = length / rate
+        start, end = 1000., 8000.
+        phase = 2 * np.pi * (start * t + (end - start) / (2 * duration) * t ** 2)
+        wave = np.sin(phase) * np.hanning(length)
+    else:
+        raise ValueError('unknown marker {}, expected click or chirp'.format(kind))
+    return (wave * amplitude * 32767).astype('<i2')
+
+
+class MarkedAudio:
+    """Silence with a marker starting on every multiple of marker_period seconds.
+
+    Markers start on the same time grid as the video frames, a marker at t starts with the sample of index
+    round(t * rate), so with a one second period they line up with the frames whose overlay reads a whole second.
+    chunk() only touches the markers that overlap the chunk, the samples themselves are never looped over.
+    """
+
+    def __init__(self, rate=48000, marker='click', marker_period=1., amplitude=.8):
+        self.rate = rate
+        self.marker = marker_wave(marker, rate, amplitude)
+        self.marker_samples = int(round(marker_period * rate))
+        if len(self.marker) > self.marker_samples:
+            raise ValueError('a {} marker does not fit a period of {} s'.format(marker, marker_period))
+
+    def chunk(self, first, count):
+        """Samples [first, first + count) as an int16 array."""
+        samples = np.zeros(count, '<i2')
+        end = first + count
+        number = max(0, (first - len(self.marker)) // self.marker_samples + 1)
+        while number * self.marker_samples < end:
+            start = number * self.marker_samples
+            low, high = max(start, first), min(start + len(self.marker), end)
+            if low < high:
+                samples[low - first:high - first] = self.marker[low - start:high - start]
+            number += 1
+        return samples
+
+
+if __name__ == '__main__':
+    kind = sys.argv[1] if len(sys.argv) > 1 else 'click'
+    chunk = float(sys.argv[2]) if len(sys.argv) > 2 else .02
+    audio = MarkedAudio(marker=kind)
+    count = int(round(chunk * audio.rate))
+    chunks = int(3600 / chunk)
+    started = perf_counter()
+    for number in range(chunks):
+        audio.chunk(number * count, count)
+    elapsed = perf_counter() - started
+    print('{} marker, {} s chunks -> one hour in {:.2f} s, {:.1f} us per chunk'.format(kind, chunk, elapsed,
+                                                                                     elapsed / chunks * 1e6))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Synthetic I420 test frames with a burnt-in text line, rendered into one preallocated buffer from cached glyphs,
+# e.g. python3 synthetic_frames.py 1920 1080 to time the renderer at a resolution
+import sys
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+BLACK = (16, 128, 128)
+WHITE = (235, 128, 128)
+
+
+class GlyphCache:
+    """Characters rendered once with cv2.putText as anti-aliased coverage masks of a common height."""
+
+    def __init__(self, characters='0123456789.:-+ ', font=cv2.FONT_HERSHEY_SIMPLEX, scale=1., thickness=1):
+        (_, ascent), baseline = cv2.getTextSize(characters, font, scale, thickness)
+        pad = thickness + 1
+        self.height = ascent + baseline + 2 * pad
+        self.masks = {}
+        for character in characters:
+            (width, _), _ = cv2.getTextSize(character, font, scale, thickness)
+            mask = np.zeros((self.height, width + thickness), np.uint8)
+            cv2.putText(mask, character, (0, pad + ascent), font, scale, 255, thickness, cv2.LINE_AA)
+            self.masks[character] = mask
+
+    def tiles(self, foreground, background):
+        """Luma tiles of every glyph, text of foreground over background, both 0-255."""
+        return {character: (background + (int(foreground) - int(background)) * (mask / 255.)).round().astype(np.uint8)
+                for character, mask in self.masks.items()}
+
+
+def i420_planes(buffer, width, height):
+    y = buffer[:width * height].reshape(height, width)
+    u = buffer[width * height:width * height * 5 // 4].reshape(height // 2, width // 2)
+    v = buffer[width * height * 5 // 4:].reshape(height // 2, width // 2)
+    return y, u, v
+
+
+class I420Renderer:
+    """Renders a line of text centred on a constant background straight into one I420 buffer.
+
+    The background is a YUV colour or a BGR image, converted once. The text only touches the luma band it covers:
+    every render restores that band from the background and copies the cached glyph tiles into it, the chroma planes
+    are never written again. render() returns the same array every time, valid until the next render.
+    """
+
+    def __init__(self, width, height, background=BLACK, foreground=WHITE, scale=None, thickness=None):
+        if width % 2 or height % 2:
+            raise ValueError('I420 needs an even size, got {}x{}'.format(width, height))
+        self.width = width
+        self.height = height
+        self.buffer = np.empty(width * height * 3 // 2, np.uint8)
+        self.y, self.u, self.v = i420_planes(self.buffer, width, height)
+        if isinstance(background, np.ndarray):
+            if background.shape[:2] != (height, width):
+                background = cv2.resize(background, (width, height), interpolation=cv2.INTER_AREA)
+            self.background = cv2.cvtColor(background, cv2.COLOR_BGR2YUV_I420).reshape(-1)
+        else:
+            self.background = np.empty_like(self.buffer)
+            for plane, value in zip(i420_planes(self.background, width, height), background):
+                plane[:] = value
+        self.background_y = i420_planes(self.background, width, height)[0]
+        self.buffer[:] = self.background
+        # sized like the original 320x240 generator, scaled with the frame height
+        scale = scale or height / 240.
+        self.glyphs = GlyphCache(scale=scale, thickness=thickness or max(1, int(round(scale))))
+        background_luma = int(np.median(self.background_y)) if isinstance(background, np.ndarray) else background[0]
+        self.tiles = self.glyphs.tiles(foreground[0], background_luma)
+        self.top = max(0, (height - self.glyphs.height) // 2)
+        self.bottom = min(height, self.top + self.glyphs.height)
+        self.dirty = None
+
+    def text_width(self, text):
+        return sum(self.tiles[character].shape[1] for character in text)
+
+    def render(self, text):
+        if self.dirty is not None:
+            left, right = self.dirty
+            self.y[self.top:self.bottom, left:right] = self.background_y[self.top:self.bottom, left:right]
+        left = max(0, (self.width - self.text_width(text)) // 2)
+        x = left
+        for character in text:
+            tile = self.tiles[character]
+            right = min(self.width, x + tile.shape[1])
+            if right <= x:
+                break
+            self.y[self.top:self.bottom, x:right] = tile[:self.bottom - self.top, :right - x]
+            x = right
+        self.dirty = (left, x)
+        return self.buffer
+
+
+if __name__ == '__main__':
+    width, height = (int(argument) for argument in sys.argv[1:3]) if len(sys.argv) > 2 else (1280, 720)
+    renderer = I420Renderer(width, height)
+    frames = 3000
+    started = perf_counter()
+    for number in range(frames):
+        renderer.render('%6f' % (number / 30.))
+    elapsed = perf_counter() - started
+    print('{}x{} -> {} frames in {:.2f} s, {:.0f} fps, {:.1f} us per frame'.format(
+        width, height, frames, elapsed, frames / elapsed, elapsed / frames * 1e6))
@@ -1,23 +1,125 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
 # Create a fake video that can test synchronization features
+# Long clips can be generated in segments on a process pool and joined without re-encoding, e.g.
+#   python3 test_gst_appsrc_testvideo_mp4mux.py --duration 7200 --segment 60
+
+import argparse
+import heapq
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 
-import cv2
 import gi
-import numpy as np
 
 gi.require_version('Gst', '1.0')
 from gi.repository import GObject, Gst
 
-if __name__ == '__main__':
-    GObject.threads_init()
-    Gst.init(None)
+from frame_buffers import FrameBufferPool, push_frame
+from synthetic_audio import MarkedAudio
+from synthetic_frames import I420Renderer
+from timestamp_barcode import TimestampBarcode
+
+AUDIO_RATE = 48000
+# whole seconds holding a whole number of 1024 sample AAC frames at AUDIO_RATE, 375 of them
+AAC_SEGMENT_SECONDS = 8
+# frames queued in the video appsrc before pushing blocks
+QUEUED_FRAMES = 4
+
+
+def x264_delay_frames(threads=0):
+    # frames x264enc holds with its default rc-lookahead of 40, plus its frame threads and their sync lookahead,
+    # threads=0 being 1.5 frame threads per core, with some room to spare
+    frame_threads = threads or (os.cpu_count() or 1) * 3 // 2
+    return 40 + 2 * frame_threads + 8
+
+
+class SampleGenerator:
+    """Merged schedule of sample streams, each one emitted every period seconds.
+
+    Only the emit times are visited, in time order, so generating a clip costs one call per sample whatever its
+    length. Times are sample index * period on a grid starting at zero, they never drift and a clip generated in
+    segments has the same samples as one generated at once; streams added first go first on ties.
+    """
+
+    def __init__(self):
+        self.streams = []
+
+    def add_stream(self, period, emit):
+        # emit(t) is called with the time of every sample in seconds
+        self.streams.append((period, emit))
+
+    def events(self, duration, start=0.):
+        end = start + duration
+        schedule = []
+        for index, (period, emit) in enumerate(self.streams):
+            # first sample of the grid at or after start, with some slack for rounding
+            number = int(math.ceil(start / period - 1e-9))
+            if number * period < end:
+                schedule.append((number * period, index, number))
+        heapq.heapify(schedule)
+        while schedule:
+            t, index, number = heapq.heappop(schedule)
+            yield t, index
+            number += 1
+            next_t = number * self.streams[index][0]
+            if next_t < end:
+                heapq.heappush(schedule, (next_t, index, number))
 
-    audio = False
+    def run(self, duration, start=0.):
+        for t, index in self.events(duration, start):
+            self.streams[index][1](t)
 
+
+def wait_for_eos(pipeline):
+    # raises RuntimeError on an error message, a segment that failed must not be joined as if it were complete
+    bus = pipeline.get_bus()
+    try:
+        while True:
+            msg = bus.poll(Gst.MessageType.ANY, Gst.CLOCK_TIME_NONE)
+            t = msg.type
+            if t == Gst.MessageType.EOS:
+                print("EOS")
+                break
+            elif t == Gst.MessageType.ERROR:
+                err, debug = msg.parse_error()
+                print("Error: %s" % err, debug)
+                raise RuntimeError("{}: {}".format(msg.src.get_name(), err.message))
+            elif t == Gst.MessageType.WARNING:
+                err, debug = msg.parse_warning()
+                print("Warning: %s" % err, debug)
+            elif t == Gst.MessageType.STATE_CHANGED:
+                pass
+            elif t == Gst.MessageType.STREAM_STATUS:
+                pass
+            else:
+                print(t)
+                print("Unknown message: %s" % msg)
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+
+def generate(location, start=0., duration=5., width=320, height=240, fps=30, audio=False, audio_chunk=.02,
+             marker='click', barcode=False, encoder_threads=0, relative=False):
+    """Encode the samples of [start, start + duration) into an mp4 file.
+
+    The overlay and subtitles always carry the absolute time of a sample. With relative the buffer timestamps start
+    at zero instead, as a segment that is later placed at start by concatenate().
+
+    Audio is pushed in chunks of audio_chunk seconds with a click or chirp marker on every whole second, when the
+    overlay reads n.000000.
+
+    With barcode a TimestampBarcode of the absolute pts and of the wall clock time the frame was generated at is
+    drawn above the text, for timestamp_barcode_analyzer.py.
+    """
     src_v = Gst.ElementFactory.make("appsrc", "vidsrc")
     vcvt = Gst.ElementFactory.make("videoconvert", "vidcvt")
     venc = Gst.ElementFactory.make("x264enc", "videnc")
+    venc.set_property("threads", encoder_threads)
 
     if audio:
         src_a = Gst.ElementFactory.make("appsrc", "audsrc")
@@ -28,7 +130,7 @@ if __name__ == '__main__':
 
     mp4mux = Gst.ElementFactory.make("mp4mux", "mux")
     filesink = Gst.ElementFactory.make("filesink", "sink")
-    filesink.set_property("location", "test.mp4")
+    filesink.set_property("location", location)
 
     pipeline = Gst.Pipeline()
     pipeline.add(src_v)
@@ -42,18 +144,27 @@ if __name__ == '__main__':
     pipeline.add(mp4mux)
     pipeline.add(filesink)
 
-    caps = Gst.Caps.from_string("video/x-raw,format=(string)I420,width=320,height=240,framerate=30/1")
+    caps = Gst.Caps.from_string("video/x-raw,format=(string)I420,width={},height={},framerate={}/1".format(
+        width, height, fps))
     src_v.set_property("caps", caps)
     src_v.set_property("format", Gst.Format.TIME)
+    # the renderer is much faster than x264enc, pushes block on a few queued frames instead of holding the clip
+    src_v.set_property("block", True)
+    src_v.set_property("max-bytes", QUEUED_FRAMES * width * height * 3 // 2)
+    in_flight_frames = x264_delay_frames(encoder_threads) + QUEUED_FRAMES
 
     if audio:
-        caps_str = "audio/x-raw,rate=48000,channels=1"
+        caps_str = "audio/x-raw,rate={},channels=1".format(AUDIO_RATE)
         caps_str += ",format=S16LE"
         caps_str += ",layout=interleaved"
         # caps_str += ",channels=1"
         caps = Gst.Caps.from_string(caps_str)
         src_a.set_property("caps", caps)
         src_a.set_property("format", Gst.Format.TIME)
+        # blocks too, but only past the audio of the frames inside the video encoder: mp4mux takes no more audio
+        # until the encoder outputs video, a smaller queue would block the pushes of the video it waits for
+        src_a.set_property("block", True)
+        src_a.set_property("max-bytes", (int(in_flight_frames / fps * AUDIO_RATE) + AUDIO_RATE) * 2)
 
     caps = Gst.Caps.from_string("text/x-raw,format=(string)utf8")
     src_s.set_property("caps", caps)
@@ -77,98 +188,160 @@ if __name__ == '__main__':
 
     pipeline.set_state(Gst.State.PLAYING)
 
+    offset = start if relative else 0.
+    renderer = I420Renderer(width, height)
+    timestamp_barcode = TimestampBarcode(width) if barcode else None
+    # enough buffers for the frames queued and held by the encoder, so they are recycled rather than allocated
+    pool = FrameBufferPool(src_v.get_property("caps"), in_flight_frames)
+
+    def gen_video(t):
+        frame = renderer.render("%6f" % t)
+        if timestamp_barcode is not None:
+            timestamp_barcode.draw_luma(renderer.y, int(round(t * 1e9)))
+        push_frame(src_v, frame, int(round((t - offset) * 1e9)), int(1e9 / fps), pool=pool)
+
+    marked_audio = MarkedAudio(AUDIO_RATE, marker)
+    chunk_samples = max(1, int(round(audio_chunk * AUDIO_RATE)))
+    offset_samples = int(round(offset * AUDIO_RATE))
+    # samples [first, last) of the clip, the next one to push is audio_position[0]
+    audio_position = [int(round(start * AUDIO_RATE))]
+    last_sample = int(round((start + duration) * AUDIO_RATE))
 
-    class SampleGenerator:
-
-        def __init__(self):
-            self._last_t_v = -31337
-            self._last_t_a = -31337
-            self._last_t_s = -31337
-
-        def gen(self, t):
-
-            if t - self._last_t_v >= 1.0 / 30:
-                data = np.zeros((240, 320, 3), dtype=np.uint8)
-                data = cv2.cvtColor(data, cv2.COLOR_RGB2YUV)
-
-                fontFace = cv2.FONT_HERSHEY_SIMPLEX
-                fontScale = 1
-                thickness = 1
-                color = (0, 255, 255)
-                text = "%6f" % t
-                oh = 0  # v[0][1]*2
-                v = cv2.getTextSize(text, fontFace, fontScale, thickness)
-                cl = int(round(160 - v[0][0] / 2))
-                cb = int(round(120 + oh - v[1] - v[0][1] / 2))
-                cv2.putText(data, text, (cl, cb), fontFace, fontScale, color, thickness)
-
-                y = data[..., 0]
-                u = data[..., 1]
-                v = data[..., 2]
-                u2 = cv2.resize(u, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
-                v2 = cv2.resize(v, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
-                data = y.tostring() + u2.tostring() + v2.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                assert buf is not None
-                buf.fill(0, data)
-                buf.pts = buf.dts = int(t * 1e9)
-                src_v.emit("push-buffer", buf)
-                self._last_t_v = t
-
-            if audio and t - self._last_t_a >= 1.0:
-                # one chunk of audio
-                data = np.zeros(int(48000 * 1.0), dtype=np.dtype('<H'))
-                data[:100] = 32767
-                data = data.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                assert buf is not None
-                buf.fill(0, data)
-                src_a.emit("push-buffer", buf)
-                buf.pts = buf.dts = int(t * 1e9)
-                self._last_t_a = t
-
-            if t - self._last_t_s >= 1.0 / 130:
-                # One sample of subtitle
-                data = ("%.6f\n" % t).encode()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                assert buf is not None
-                buf.fill(0, data)
-                buf.pts = buf.dts = int(t * 1e9)
-                buf.duration = int(1e9 * 1.0 / 130)
-                src_s.emit("push-buffer", buf)
-                self._last_t_s = t
+    def push_audio(end):
+        # samples from where the previous chunk ended up to end, timestamped from their index before they are pushed
+        first = audio_position[0]
+        if end <= first:
+            return
+        pts = (first - offset_samples) * Gst.SECOND // AUDIO_RATE
+        push_frame(src_a, marked_audio.chunk(first, end - first), pts,
+                   (end - offset_samples) * Gst.SECOND // AUDIO_RATE - pts, offset=first - offset_samples)
+        audio_position[0] = end
 
+    def gen_audio(t):
+        # one chunk of audio ending a chunk after t. A segment rarely starts on the chunk grid, its first chunk
+        # also takes the samples between its start and t, so that segments join without a hole
+        push_audio(min(int(round(t * AUDIO_RATE)) + chunk_samples, last_sample))
+
+    def gen_subtitle(t):
+        # One sample of subtitle
+        data = ("%.6f\n" % t).encode()
+        buf = Gst.Buffer.new_allocate(None, len(data), None)
+        assert buf is not None
+        buf.fill(0, data)
+        buf.pts = buf.dts = int(round((t - offset) * 1e9))
+        buf.duration = int(1e9 * 1.0 / 130)
+        src_s.emit("push-buffer", buf)
 
     s = SampleGenerator()
-    for t in np.arange(0, 5, 0.000001):
-        s.gen(t)
+    s.add_stream(1.0 / fps, gen_video)
+    if audio:
+        s.add_stream(chunk_samples / AUDIO_RATE, gen_audio)
+    s.add_stream(1.0 / 130, gen_subtitle)
+    s.run(duration, start)
 
     src_v.emit("end-of-stream")
     if audio:
+        # a segment shorter than a chunk may have no chunk starting in it
+        push_audio(last_sample)
         src_a.emit("end-of-stream")
     src_s.emit("end-of-stream")
 
-    bus = pipeline.get_bus()
-    while True:
-        msg = bus.poll(Gst.MessageType.ANY, Gst.CLOCK_TIME_NONE)
-        t = msg.type
-        if t == Gst.MessageType.EOS:
-            print("EOS")
-            break
-            pipeline.set_state(Gst.State.NULL)
-        elif t == Gst.MessageType.ERROR:
-            err, debug = msg.parse_error()
-            print("Error: %s" % err, debug)
-            break
-        elif t == Gst.MessageType.WARNING:
-            err, debug = msg.parse_warning()
-            print("Warning: %s" % err, debug)
-        elif t == Gst.MessageType.STATE_CHANGED:
-            pass
-        elif t == Gst.MessageType.STREAM_STATUS:
-            pass
-        else:
-            print(t)
-            print("Unknown message: %s" % msg)
+    wait_for_eos(pipeline)
+    pool.close()
+
+
+def generate_segment(arguments):
+    # runs in a pool process, which has its own gstreamer
+    location, start, duration, options = arguments
+    Gst.init(None)
+    started = perf_counter()
+    generate(location, start, duration, encoder_threads=1, relative=True, **options)
+    return location, perf_counter() - started
+
+
+def concatenate(locations, location):
+    """Join mp4 segments into one mp4 without re-encoding.
+
+    splitmuxsrc plays the segments as one stream, each placed after the previous one, and its streams are remuxed
+    as they are.
+    """
+    pipeline = Gst.Pipeline()
+    src = Gst.ElementFactory.make("splitmuxsrc", "src")
+    mp4mux = Gst.ElementFactory.make("mp4mux", "mux")
+    filesink = Gst.ElementFactory.make("filesink", "sink")
+    filesink.set_property("location", location)
+    pipeline.add(src)
+    pipeline.add(mp4mux)
+    pipeline.add(filesink)
+    mp4mux.link(filesink)
+
+    def on_format_location(src):
+        return locations
+
+    def on_pad_added(src, pad):
+        res = pad.link(mp4mux.get_compatible_pad(pad, None))
+        assert res == Gst.PadLinkReturn.OK, res
+
+    src.connect("format-location", on_format_location)
+    src.connect("pad-added", on_pad_added)
+    pipeline.set_state(Gst.State.PLAYING)
+    wait_for_eos(pipeline)
+
+
+def generate_parallel(location, duration, segment=60., workers=None, **options):
+    """Generate [0, duration) as segments of segment seconds on a process pool, then join them into location.
+
+    Segments are cut on whole seconds so that they start on a video frame and a subtitle sample of the common grid.
+    With audio they are cut on multiples of AAC_SEGMENT_SECONDS: the encoder pads the last AAC frame of a segment,
+    and splitmuxsrc places every part after the previous one, so a partial frame would shift the rest of the clip.
+    """
+    step = AAC_SEGMENT_SECONDS if options.get("audio") else 1
+    segment = max(1, int(round(segment / step))) * step
+    starts = list(range(0, int(math.ceil(duration)), segment))
+    directory = tempfile.mkdtemp(prefix="testvideo_", dir=os.path.dirname(os.path.abspath(location)))
+    arguments = [(os.path.join(directory, "segment_{:06d}.mp4".format(number)), start,
+                  min(segment, duration - start), options) for number, start in enumerate(starts)]
+    try:
+        started = perf_counter()
+        # spawned rather than forked, gstreamer does not survive a fork once its threads run
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for segment_location, elapsed in pool.map(generate_segment, arguments):
+                print("{} -> {:.1f} s".format(segment_location, elapsed))
+        print("{} segments generated in {:.1f} s".format(len(arguments), perf_counter() - started))
+
+        Gst.init(None)
+        started = perf_counter()
+        concatenate([item[0] for item in arguments], location)
+        print("joined in {:.1f} s".format(perf_counter() - started))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthetic A/V sync test clip")
+    parser.add_argument("--location", default="test.mp4")
+    parser.add_argument("--duration", type=float, default=5.)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--audio", action="store_true")
+    parser.add_argument("--audio-chunk", type=float, default=.02, help="seconds of audio per buffer")
+    parser.add_argument("--marker", choices=("click", "chirp"), default="click",
+                        help="audio marker on every whole second")
+    parser.add_argument("--barcode", action="store_true", help="burn a machine readable timestamp barcode")
+    parser.add_argument("--segment", type=float,
+                        help="generate segments of this many seconds in parallel, rounded to whole seconds, "
+                             "to multiples of {} s with --audio".format(AAC_SEGMENT_SECONDS))
+    parser.add_argument("--workers", type=int, help="processes generating segments, one per core by default")
+    args = parser.parse_args()
+    options = dict(width=args.width, height=args.height, fps=args.fps, audio=args.audio, audio_chunk=args.audio_chunk,
+                   marker=args.marker, barcode=args.barcode)
+
+    if args.segment:
+        generate_parallel(args.location, args.duration, args.segment, args.workers, **options)
+    else:
+        GObject.threads_init()
+        Gst.init(None)
+        generate(args.location, 0., args.duration, **options)
 
     print("Bye")
@@ -9,6 +9,9 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_sources import launch_source
+from media_pool import ElementPool, SdpCache, create_sdp_caching_client
+
 loop = GObject.MainLoop()
 GObject.threads_init()
 Gst.init(None)
@@ -19,7 +22,8 @@ class MyFactory(GstRtspServer.RTSPMediaFactory):
         GstRtspServer.RTSPMediaFactory.__init__(self)
 
     def do_create_element(self, url):
-        s_src = "v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ! video/x-raw,format=I420"
+        s_src = "{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ! video/x-raw,format=I420".format(
+            launch_source(320, 240))
         # s_h264 = "videoconvert ! vaapiencode_h264 bitrate=1000"
         # s_src = "videotestsrc ! video/x-raw,rate=30,width=320,height=240,format=I420"
         s_h264 = "x264enc tune=zerolatency"
@@ -36,20 +40,20 @@ class CameraFactory(GstRtspServer.RTSPMediaFactory):
         super(CameraFactory, self).__init__(**properties)
 
     def do_create_element(self, url):
-        launch_string = 'v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
+        launch_string = '{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
                         '! video/x-raw,format=I420 ! queue max-size-buffers=1 ' \
                         '! x264enc bitrate=256 speed-preset=ultrafast tune=zerolatency bitrate=256 ' \
-                        '! rtph264pay name=pay0 pt=96'
+                        '! rtph264pay name=pay0 pt=96'.format(launch_source(320, 240))
         return Gst.parse_launch(launch_string)
 
 
 class LaunchCameraFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(LaunchCameraFactory, self).__init__(**properties)
-        launch_String = 'v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
+        launch_String = '{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
                         '! video/x-raw,format=I420 ! queue max-size-buffers=1 ' \
                         '! x264enc bitrate=256 speed-preset=ultrafast tune=zerolatency bitrate=256 ' \
-                        '! rtph264pay name=pay0 pt=96'
+                        '! rtph264pay name=pay0 pt=96'.format(launch_source(320, 240))
         self.set_launch(launch_String)
 
 
@@ -71,20 +75,20 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         super(SensorFactory, self).__init__(**properties)
 
     def do_create_element(self, url):
-        launch_string = 'v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
+        launch_string = '{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
                         '! video/x-raw,format=I420 ! queue max-size-buffers=1 ' \
                         '! x264enc bitrate=256 speed-preset=ultrafast tune=zerolatency bitrate=256 ' \
-                        '! rtph264pay name=pay0 pt=96'
+                        '! rtph264pay name=pay0 pt=96'.format(launch_source(320, 240))
         return Gst.parse_launch(launch_string)
 
 
 class FakeFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(FakeFactory, self).__init__(**properties)
-        launch_string = 'v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
+        launch_string = '{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ' \
                         '! video/x-raw,format=I420 ! queue max-size-buffers=1 ' \
                         '! x264enc bitrate=256 speed-preset=ultrafast tune=zerolatency bitrate=256 ' \
-                        '! rtph264pay name=pay0 pt=96'
+                        '! rtph264pay name=pay0 pt=96'.format(launch_source(320, 240))
         self.set_launch(launch_string)
 
 
@@ -117,9 +121,26 @@ class CompressedRedirectFactory(GstRtspServer.RTSPMediaFactory):
         print('error message -> {}'.format(message.parse_error().debug))
 
 
+class PooledFactory(GstRtspServer.RTSPMediaFactory):
+    """Non-shared mount, every client gets its own pipeline taken from a pool of pre-built ones."""
+
+    def __init__(self, pool_size=2, **properties):
+        super(PooledFactory, self).__init__(**properties)
+        self.launch_string = '( videotestsrc is-live=true ! video/x-raw,width=1280,height=720 ' \
+                             '! videoconvert ! x264enc speed-preset=ultrafast tune=zerolatency ' \
+                             '! rtph264pay name=pay0 pt=96 )'
+        self.set_shared(False)
+        self.pool = ElementPool(lambda: Gst.parse_launch(self.launch_string), pool_size)
+        self.pool.start()
+
+    def do_create_element(self, url):
+        return self.pool.take()
+
+
 class GstServer(GstRtspServer.RTSPServer):
     def __init__(self, **properties):
         super(GstServer, self).__init__(**properties)
+        self.sdp_cache = SdpCache()
         self.factory = GstRtspServer.RTSPMediaFactory()
         launch_string = 'videotestsrc ! video/x-raw,width=1280,height=720 ' \
                         '! videoconvert ! x264enc speed-preset=ultrafast tune=zerolatency ' \
@@ -127,11 +148,23 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory.set_launch(launch_string)
         self.factory.set_shared(True)
         self.get_mount_points().add_factory("/test", self.factory)
+        self.pooled_factory = PooledFactory()
+        self.get_mount_points().add_factory("/pooled", self.pooled_factory)
+        GObject.timeout_add_seconds(3, self.check_health)
         # self.factory = SensorFactory()
         # self.factory.set_shared(True)
         # self.get_mount_points().add_factory("/test", self.factory)
         self.attach(None)
 
+    def do_create_client(self):
+        return create_sdp_caching_client(self, self.sdp_cache)
+
+    def check_health(self):
+        print('media_pool: {}'.format(self.pooled_factory.pool))
+        print('sdp_cache: {}'.format(self.sdp_cache))
+
+        return True
+
 
 if __name__ == '__main__':
     s = GstServer()
@@ -10,6 +10,8 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_sources import launch_source
+
 loop = GObject.MainLoop()
 GObject.threads_init()
 Gst.init(None)
@@ -20,7 +22,8 @@ class MyFactory(GstRtspServer.RTSPMediaFactory):
         GstRtspServer.RTSPMediaFactory.__init__(self)
 
     def do_create_element(self, url):
-        s_src = "v4l2src ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ! video/x-raw,format=I420"
+        s_src = "{} ! video/x-raw,rate=30,width=320,height=240 ! videoconvert ! video/x-raw,format=I420".format(
+            launch_source(320, 240))
         # s_h264 = "videoconvert ! vaapiencode_h264 bitrate=1000"
         # s_src = "videotestsrc ! video/x-raw,rate=30,width=320,height=240,format=I420"
         s_h264 = "x264enc tune=zerolatency"
@@ -9,6 +9,9 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_buffers import push_frame
+from frame_sources import open_frame_source
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
@@ -60,7 +63,7 @@ th.start()
 
 print('Thread started')
 
-cap = cv2.VideoCapture(0)
+cap = open_frame_source(640, 480, 30.)
 
 print(cap.isOpened())
 
@@ -77,16 +80,9 @@ while cap.isOpened():
 
         print('Writing buffer')
 
-        data = frame.tostring()
-
-        buf = Gst.Buffer.new_allocate(None, len(data), None)
-        buf.fill(0, data)
-        buf.duration = fps
         timestamp = clock() - timestamp
-        buf.pts = buf.dts = int(timestamp)
-        buf.offset = frame_number
+        retval = push_frame(server.factory.appsrc, frame, timestamp, fps, offset=frame_number)
         frame_number += 1
-        retval = server.factory.appsrc.emit('push-buffer', buf)
         if retval != Gst.FlowReturn.OK:
             print(retval)
 
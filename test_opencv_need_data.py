@@ -1,18 +1,20 @@
 #!/usr/bin/env python3
 from time import clock
 
-import cv2
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_buffers import push_frame
+from frame_sources import open_frame_source
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
         super(SensorFactory, self).__init__(**properties)
-        self.cap = cv2.VideoCapture(0)
+        self.cap = open_frame_source(640, 480, 30.)
         self.number_frames = 0
         self.fps = 30
         self.duration = 1 / self.fps * (10 ** 6)
@@ -29,15 +31,9 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         if self.cap.isOpened():
             ret, frame = self.cap.read()
             if ret:
-                data = frame.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
                 timestamp = self.number_frames * self.duration
-                buf.pts = buf.dts = int(timestamp)
-                buf.offset = timestamp
                 self.number_frames += 1
-                retval = src.emit('push-buffer', buf)
+                retval = push_frame(src, frame, timestamp, self.duration, offset=timestamp)
                 print('pushed buffer, frame {}, duration {}'.format(self.number_frames, self.duration))
                 if retval != Gst.FlowReturn.OK:
                     print(retval)
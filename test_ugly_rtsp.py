@@ -8,6 +8,8 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_sources import open_frame_source
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
@@ -41,10 +43,10 @@ th.start()
 
 print('Thread started')
 
-cap = cv2.VideoCapture(0)
-
 framerate = 5.0
 
+cap = open_frame_source(640, 480, framerate)
+
 out = cv2.VideoWriter('appsrc ! videoconvert ! '
                       'x264enc bitrate=256 speed-preset=ultrafast tune=zerolatency bitrate=256 ! '
                       'rtph264pay config-interval=1 pt=96 ! gdppay ! '
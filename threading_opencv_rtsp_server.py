@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from threading import Thread
+from time import monotonic
 
 import cv2
 import gi
@@ -8,6 +9,11 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from frame_buffers import FrameBufferPool, push_frame
+from frame_mailbox import LatestFrameMailbox
+from frame_sources import open_frame_source
+from metrics import MediaMetrics, add_server_metrics, metrics
+
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
     def __init__(self, **properties):
@@ -15,27 +21,34 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         self.number_frames = 0
         self.fps = 30.
         self.duration = 1 / self.fps * Gst.SECOND  # duration of a frame in nanoseconds
+        self.buffer_frames = 3
+        self.use_buffer_pool = False
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
+        self.pool = None
         self.launch_string = 'appsrc name=source is-live=true format=GST_FORMAT_TIME ' \
                              'caps=video/x-raw,format=BGR,width=640,height=480,framerate={}/1 ' \
                              '! videoconvert ! video/x-raw,format=I420 ' \
-                             '! x264enc speed-preset=fast tune=zerolatency bitrate=256 ' \
+                             '! x264enc name=encoder speed-preset=fast tune=zerolatency bitrate=256 ' \
                              '! rtph264pay config-interval=1 name=pay0 pt=96'.format(int(self.fps))
-        self.frame = None
-
-    def set_last_frame(self, frame):
-        self.frame = frame
-
-    def on_need_data(self, src, lenght):
-        if self.frame is not None:
-            data = self.frame.tostring()
-            buf = Gst.Buffer.new_allocate(None, len(data), None)
-            buf.fill(0, data)
-            buf.duration = self.duration
+        self.frames = LatestFrameMailbox()
+        self.frame_timeout = 2 / self.fps
+        self.sequence = 0
+        self.frame_lag = None
+
+    def set_last_frame(self, frame, timestamp=None):
+        self.frames.publish(frame, timestamp)
+
+    def on_need_data(self, src, lenght, media_metrics):
+        # wait a little for a fresh frame, repeat the latest one if the camera is late
+        frame = self.frames.wait_newer(self.sequence, self.frame_timeout) or self.frames.latest()
+        if frame.data is not None:
+            self.sequence = frame.sequence
+            self.frame_lag = self.frames.lag(frame)
             timestamp = self.number_frames * self.duration
-            buf.pts = buf.dts = int(timestamp)
-            buf.offset = timestamp
             self.number_frames += 1
-            retval = src.emit('push-buffer', buf)
+            retval = push_frame(src, frame.data, timestamp, self.duration, offset=timestamp, pool=self.pool)
+            media_metrics.pushed(retval)
             print('pushed buffer, frame {}, duration {} ns, durations {} s'.format(self.number_frames,
                                                                                    self.duration,
                                                                                    self.duration / Gst.SECOND))
@@ -47,8 +60,14 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
 
     def do_configure(self, rtsp_media):
         self.number_frames = 0
+        self.sequence = 0
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data)
+        if self.use_buffer_pool:
+            self.pool = FrameBufferPool(appsrc.get_property('caps'), self.buffer_frames)
+            rtsp_media.connect('unprepared', self.pool.close)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        appsrc.connect('need-data', self.on_need_data, media_metrics)
 
 
 class GstServer(GstRtspServer.RTSPServer):
@@ -58,20 +77,21 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory.set_shared(True)
         self.get_mount_points().add_factory("/stream", self.factory)
         GObject.timeout_add_seconds(60, self.clean_pools)
-        GObject.timeout_add_seconds(3, self.check_health)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        metrics.serve()
         self.attach(None)
 
-    def set_last_frame(self, frame):
-        self.factory.set_last_frame(frame)
+    def set_last_frame(self, frame, timestamp=None):
+        self.factory.set_last_frame(frame, timestamp)
 
-    def check_health(self):
-        thread_pool = self.get_thread_pool()
-        session_pool = self.get_session_pool()
-        print('thread_pool: max_threads {}'.format(thread_pool.get_max_threads()))
-        print('session_pool: max_sessions {}, n_sessions {}'.format(session_pool.get_max_sessions(),
-                                                                    session_pool.get_n_sessions()))
-
-        return True
+    def collect(self):
+        samples = []
+        if self.factory.frame_lag is not None:
+            samples.append(('gst_frame_lag_seconds', {}, round(self.factory.frame_lag, 6)))
+        if self.factory.pool is not None:
+            samples.append(('gst_buffer_pool_dry_total', {}, self.factory.pool.dry))
+        return samples
 
     def clean_pools(self):
         clean_count = self.get_session_pool().cleanup()
@@ -97,21 +117,21 @@ class LiveStreamingServer(Thread):
     def start(self):
         self.thread.start()
 
-    def set_last_frame(self, frame):
-        self.server.set_last_frame(frame)
+    def set_last_frame(self, frame, timestamp=None):
+        self.server.set_last_frame(frame, timestamp)
 
 
 s = LiveStreamingServer()
 s.start()
 
-cap = cv2.VideoCapture(0)
+cap = open_frame_source(640, 480, 30.)
 
 while cap.isOpened():
     ret, frame = cap.read()
     if ret:
 
         # write the flipped frame
-        s.set_last_frame(frame)
+        s.set_last_frame(frame, monotonic())
 
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 import sys
 from threading import Thread
+from time import monotonic
 
-import cv2
 import gi
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstRtspServer', '1.0')
 from gi.repository import Gst, GstRtspServer, GObject
 
+from adaptive_bitrate import BitrateController, open_bitrate_log
+from colour_conversion import make_conversion_stage
+from frame_buffers import FrameBufferPool, push_frame
+from frame_mailbox import ConvertedFrameCache, LatestFrameMailbox
+from frame_sources import open_frame_source
+from latency_tracer import LatencyTracer
+from metrics import MediaMetrics, add_server_metrics, metrics
+
 
 class Context:
     def __init__(self):
         self._timestamp = 0
         self._need_data = True
+        self._sequence = 0
 
     @property
     def timestamp(self):
@@ -31,8 +40,17 @@ class Context:
     def need_data(self, value):
         self._need_data = value
 
+    @property
+    def sequence(self):
+        return self._sequence
+
+    @sequence.setter
+    def sequence(self, value):
+        self._sequence = value
+
     def __str__(self):
-        return 'timestamp -> {}, need_data -> {}'.format(self._timestamp, self._need_data)
+        return 'timestamp -> {}, need_data -> {}, sequence -> {}'.format(self._timestamp, self._need_data,
+                                                                         self._sequence)
 
 
 class SensorFactory(GstRtspServer.RTSPMediaFactory):
@@ -46,16 +64,33 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
             self.height = 480
         self.fps = 6.
         self.bitrate = 256
+        # the encoder bitrate follows the clients' RTCP receiver reports within these bounds, in kbit/s
+        # off by default, every media then appends its decisions to adaptive_bitrate.csv
+        self.adaptive_bitrate = False
+        self.min_bitrate = 64
+        self.max_bitrate = 1024
+        self.bitrate_controller = None
         self.buffer_frames = 3
+        self.use_buffer_pool = False
+        # per element latency histograms on the metrics endpoint, costs a probe per element and buffer
+        self.trace_latency = False
+        # encoder throughput on the metrics endpoint, costs a probe on every encoder buffer
+        self.time_encoder = False
+        self.pool = None
         self.frame_size = self.width * self.height * 3
         self.buffer_size = self.frame_size * self.buffer_frames
         self.key_int_max = 0
         self.duration = int(1 / self.fps * Gst.SECOND)  # duration of a frame in nanoseconds
+        self.conversion = make_conversion_stage(self.width, self.height, 'cv2')
         launch_string = '( appsrc name=source is-live=true format=GST_FORMAT_TIME blocksize={} ' \
-                        'caps=video/x-raw,format=I420,width={},height={},framerate={}/1 ' \
-                        '! x264enc key-int-max={} speed-preset=ultrafast bitrate={} tune=zerolatency ' \
-                        '! rtph264pay config-interval=1 name=pay0 pt=96 )'.format(self.buffer_size, self.width,
-                                                                                  self.height, int(self.fps),
+                        'caps=video/x-raw,format={},width={},height={},framerate={}/1 ' \
+                        '! {}x264enc name=encoder key-int-max={} speed-preset=ultrafast bitrate={} ' \
+                        'tune=zerolatency ' \
+                        '! rtph264pay config-interval=1 name=pay0 pt=96 )'.format(self.buffer_size,
+                                                                                  self.conversion.input_format,
+                                                                                  self.width, self.height,
+                                                                                  int(self.fps),
+                                                                                  self.conversion.launch_fragment(),
                                                                                   self.key_int_max, self.bitrate)
 
         print(launch_string)
@@ -63,38 +98,66 @@ class SensorFactory(GstRtspServer.RTSPMediaFactory):
         self.set_shared(True)
         self.set_eos_shutdown(True)
         self.set_latency(500)
-        self.frame = None
+        self.frame_timeout = 1.
+        self.frames = LatestFrameMailbox()
+        self.converted_frames = ConvertedFrameCache(self.conversion)
+        self.frame_lag = None
 
-    def set_last_frame(self, frame):
-        self.frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+    def set_last_frame(self, frame, timestamp=None):
+        # frames are converted only when a media pushes them, see on_need_data
+        self.frames.publish(frame, timestamp)
 
-    def on_need_data(self, src, lenght, context):
+    def on_need_data(self, src, lenght, context, media_metrics):
         print('context address -> {}'.format(id(context)))
         print('need_data lenght -> {}, context -> {}'.format(lenght, context))
         context.need_data = True
         while context.need_data:
-            if self.frame is not None:
-                data = self.frame.tostring()
-                buf = Gst.Buffer.new_allocate(None, len(data), None)
-                buf.fill(0, data)
-                buf.duration = self.duration
-                buf.pts = buf.dts = context.timestamp
-                context.timestamp += buf.duration
-                retval = src.emit('push-buffer', buf)
-                if retval != Gst.FlowReturn.OK:
-                    print(retval)
-                    context.need_data = False
+            frame = self.frames.wait_newer(context.sequence, self.frame_timeout, lambda: not context.need_data)
+            if frame is None or not context.need_data:
+                continue
+            frame = self.converted_frames.get(frame)
+            if context.sequence:
+                # frames published since the previous push were never seen by this media
+                media_metrics.dropped(frame.sequence - context.sequence - 1)
+            context.sequence = frame.sequence
+            self.frame_lag = self.frames.lag(frame)
+            retval = push_frame(src, frame.data, context.timestamp, self.duration, pool=self.pool)
+            context.timestamp += self.duration
+            media_metrics.pushed(retval)
+            if retval != Gst.FlowReturn.OK:
+                print(retval)
+                context.need_data = False
         print('context -> {}'.format(context))
 
     def on_enough_data(self, src, context):
         print('context address -> {}'.format(id(context)))
         print('enough_data context -> {}'.format(context))
         context.need_data = False
+        self.frames.wake()
+
+    def on_unprepared(self, rtsp_media, context):
+        context.need_data = False
+        self.frames.wake()
 
     def do_configure(self, rtsp_media):
         ctx = Context()
+        rtsp_media.connect('unprepared', self.on_unprepared, ctx)
         appsrc = rtsp_media.get_element().get_child_by_name('source')
-        appsrc.connect('need-data', self.on_need_data, ctx)
+        if self.use_buffer_pool:
+            self.pool = FrameBufferPool(appsrc.get_property('caps'), self.buffer_frames)
+            rtsp_media.connect('unprepared', self.pool.close)
+        encoder = rtsp_media.get_element().get_child_by_name('encoder')
+        media_metrics = MediaMetrics('sensor', rtsp_media, appsrc, encoder if self.time_encoder else None)
+        if self.trace_latency:
+            LatencyTracer(appsrc, media_metrics.labels, rtsp_media)
+        if self.adaptive_bitrate:
+            self.bitrate_controller = BitrateController(encoder, self.min_bitrate, self.max_bitrate,
+                                                        initial=self.bitrate, log=open_bitrate_log(),
+                                                        close_log=True)
+            self.bitrate_controller.add_media(rtsp_media)
+            rtsp_media.connect('unprepared', self.bitrate_controller.stop)
+            self.bitrate_controller.start()
+        appsrc.connect('need-data', self.on_need_data, ctx, media_metrics)
         appsrc.connect('enough-data', self.on_enough_data, ctx)
 
 
@@ -104,20 +167,23 @@ class GstServer(GstRtspServer.RTSPServer):
         self.factory = SensorFactory()
         self.get_mount_points().add_factory("/stream", self.factory)
         print(self.get_backlog())
-        GObject.timeout_add_seconds(3, self.check_health)
+        add_server_metrics(self)
+        metrics.add_collector(self.factory, self.collect)
+        metrics.serve()
         self.attach(None)
 
-    def set_last_frame(self, frame):
-        self.factory.set_last_frame(frame)
-
-    def check_health(self):
-        thread_pool = self.get_thread_pool()
-        session_pool = self.get_session_pool()
-        print('thread_pool: max_threads {}'.format(thread_pool.get_max_threads()))
-        print('session_pool: max_sessions {}, n_sessions {}'.format(session_pool.get_max_sessions(),
-                                                                    session_pool.get_n_sessions()))
+    def set_last_frame(self, frame, timestamp=None):
+        self.factory.set_last_frame(frame, timestamp)
 
-        return True
+    def collect(self):
+        samples = [('gst_frame_conversions_total', {}, self.factory.converted_frames.converted)]
+        if self.factory.frame_lag is not None:
+            samples.append(('gst_frame_lag_seconds', {}, round(self.factory.frame_lag, 6)))
+        if self.factory.pool is not None:
+            samples.append(('gst_buffer_pool_dry_total', {}, self.factory.pool.dry))
+        if self.factory.bitrate_controller is not None:
+            samples.append(('gst_encoder_bitrate', {}, int(self.factory.bitrate_controller.bitrate)))
+        return samples
 
 
 class LiveStreamingServer:
@@ -129,8 +195,8 @@ class LiveStreamingServer:
     def start(self):
         self.thread.start()
 
-    def set_last_frame(self, frame):
-        self.server.set_last_frame(frame)
+    def set_last_frame(self, frame, timestamp=None):
+        self.server.set_last_frame(frame, timestamp)
 
 
 GObject.threads_init()
@@ -139,14 +205,15 @@ Gst.init(None)
 s = LiveStreamingServer()
 s.start()
 
-cap = cv2.VideoCapture(0)
+factory = s.server.factory
+cap = open_frame_source(factory.width, factory.height, 30.)
 
 print('cap.isOpened() -> {}'.format(cap.isOpened()))
 
 while cap.isOpened():
     ret, frame = cap.read()
     if ret:
-        s.set_last_frame(frame)
+        s.set_last_frame(frame, monotonic())
         # print('Wrote frame to the server')
 
 # Release everything if job is finished
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Machine readable strip of cells burnt into the top of a frame, carrying its pts and the wall clock time it was
+# captured at, drawn and read back with numpy only
+from time import time
+
+import numpy as np
+
+BLACK = 16
+WHITE = 235
+# pts in nanoseconds, wall clock in microseconds since the epoch, then a checksum of both
+FIELDS = (64, 64, 16)
+BITS = sum(FIELDS)
+
+
+def checksum(pts, wall):
+    # xor of the 16 bit words of both fields, salted so that an all black strip does not pass
+    value = 0xa5a5
+    for field in (pts, wall):
+        for shift in range(0, 64, 16):
+            value ^= (field >> shift) & 0xffff
+    return value
+
+
+def to_bits(value, length):
+    return (np.uint64(value) >> np.arange(length - 1, -1, -1, dtype=np.uint64)) & np.uint64(1)
+
+
+def from_bits(bits):
+    # bits is a whole number of bytes, most significant bit first
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class TimestampBarcode:
+    """Rows of square cells, each row framed by a white and a black reference cell.
+
+    Cells are sized from the frame width alone, cell = width / (bits_per_row + 2) pixels, fractional cells are
+    rounded to whole pixels when drawn. The geometry scales with the frame, so a reader only needs the frame it
+    got to find them, also once the stream was rescaled on the way. A row is read by averaging the inner half of
+    every cell around its centre and thresholding it halfway between the row's reference cells, which survives
+    encoding, scaling and a change of brightness.
+    """
+
+    def __init__(self, width, bits_per_row=48, top=0):
+        self.width = width
+        self.bits_per_row = bits_per_row
+        self.top = top
+        self.columns = bits_per_row + 2
+        self.cell = width / self.columns
+        if self.cell < 2:
+            raise ValueError('a frame {} pixels wide is too narrow for {} bits per row'.format(width, bits_per_row))
+        self.rows = -(-BITS // bits_per_row)
+        # first pixel of every cell and one past the last one
+        self.row_edges = np.round(np.arange(self.rows + 1) * self.cell).astype(np.intp)
+        self.column_edges = np.round(np.arange(self.columns + 1) * self.cell).astype(np.intp)
+        self.height = int(self.row_edges[-1])
+        self.strip = np.full((self.height, width), BLACK, np.uint8)
+        # pixels averaged by read(), the inner half of every cell around its centre
+        inner = max(1, int(self.cell / 2))
+        window = np.arange(inner) - (inner - 1) // 2
+        self.sample_rows = ((np.arange(self.rows) + .5) * self.cell).astype(np.intp)[:, None] + window
+        self.sample_columns = ((np.arange(self.columns) + .5) * self.cell).astype(np.intp)[:, None] + window
+
+    def cells(self, pts, wall):
+        bits = np.zeros(self.rows * self.bits_per_row, np.uint8)
+        bits[:BITS] = np.concatenate([to_bits(pts, 64), to_bits(wall, 64),
+                                      to_bits(checksum(pts, wall), 16)]).astype(np.uint8)
+        cells = np.empty((self.rows, self.columns), np.uint8)
+        cells[:, 0] = 1
+        cells[:, 1:-1] = bits.reshape(self.rows, self.bits_per_row)
+        cells[:, -1] = 0
+        return cells
+
+    def render(self, pts, wall=None):
+        """The strip as luma rows, pts in nanoseconds and wall in microseconds, now by default."""
+        wall = int(time() * 1e6) if wall is None else wall
+        levels = np.where(self.cells(int(pts), int(wall)), WHITE, BLACK).astype(np.uint8)
+        self.strip[:, :self.column_edges[-1]] = levels.repeat(np.diff(self.row_edges), axis=0).repeat(
+            np.diff(self.column_edges), axis=1)
+        return self.strip
+
+    def draw_luma(self, y, pts, wall=None):
+        y[self.top:self.top + self.height] = self.render(pts, wall)
+
+    def draw_bgr(self, frame, pts, wall=None):
+        frame[self.top:self.top + self.height] = self.render(pts, wall)[..., None]
+
+    def read(self, luma):
+        """(pts, wall) read from a luma frame, None when the checksum does not match."""
+        strip = luma[self.top:self.top + self.height]
+        if strip.shape[0] != self.height or strip.shape[1] < self.column_edges[-1]:
+            return None
+        cells = strip[self.sample_rows[:, :, None, None], self.sample_columns[None, None]].astype(np.float32)
+        means = cells.mean(axis=(1, 3))
+        white, black = means[:, 0], means[:, -1]
+        if np.any(white - black < (WHITE - BLACK) / 4):
+            return None
+        bits = (means[:, 1:-1] > ((white + black) / 2)[:, None]).reshape(-1)[:BITS]
+        pts, wall, check = from_bits(bits[:64]), from_bits(bits[64:128]), from_bits(bits[128:])
+        if check != checksum(pts, wall):
+            return None
+        return pts, wall
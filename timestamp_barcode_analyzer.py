@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Reads the timestamp barcodes back from a received stream or a recording and reports, at full frame rate, the glass
+# to glass latency (live streams, sender and receiver clocks must agree), the clock drift between pts and wall clock
+# and the frames skipped or repeated on the way, e.g.
+#   FRAME_SOURCE=pattern FRAME_BARCODE=1 python3 opencv_rtsp_server.py
+#   python3 timestamp_barcode_analyzer.py rtsp://127.0.0.1:8554/stream --frames 900
+#   python3 timestamp_barcode_analyzer.py test.mp4 --csv barcodes.csv
+import argparse
+import os
+from time import time
+
+import gi
+import numpy as np
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GstVideo
+
+from timestamp_barcode import TimestampBarcode
+
+
+def to_uri(location):
+    return location if '://' in location else Gst.filename_to_uri(os.path.abspath(location))
+
+
+class BarcodeAnalyzer:
+    """Decodes the barcode of every frame and keeps what is needed for the report as numpy arrays."""
+
+    def __init__(self, bits_per_row=48, top=0, live=False, csv=None):
+        self.bits_per_row = bits_per_row
+        self.top = top
+        self.live = live
+        self.csv = csv
+        self.barcode = None
+        self.frames = 0
+        self.failed = 0
+        self.rows = []
+        if csv is not None:
+            csv.write('frame,stream_pts,pts,wall,received,latency_ms\n')
+
+    def analyze(self, luma, stream_pts, received):
+        self.frames += 1
+        if self.barcode is None or self.barcode.width != luma.shape[1]:
+            self.barcode = TimestampBarcode(luma.shape[1], self.bits_per_row, self.top)
+        decoded = self.barcode.read(luma)
+        if decoded is None:
+            self.failed += 1
+            return
+        pts, wall = decoded
+        stream_pts = None if stream_pts == Gst.CLOCK_TIME_NONE else stream_pts
+        latency = received - wall / 1e6 if self.live else None
+        self.rows.append((pts, wall, received, np.nan if stream_pts is None else stream_pts))
+        if self.csv is not None:
+            self.csv.write('{},{},{},{},{:.6f},{}\n'.format(self.frames - 1, '' if stream_pts is None else stream_pts,
+                                                           pts, wall, received,
+                                                           '' if latency is None else '{:.3f}'.format(latency * 1000)))
+
+    def report(self):
+        print('frames -> {}, decoded -> {}, unreadable -> {}'.format(self.frames, len(self.rows), self.failed))
+        if len(self.rows) < 2:
+            return
+        rows = np.array(self.rows, dtype=np.float64)
+        pts, wall, received, stream_pts = rows[:, 0] / 1e9, rows[:, 1] / 1e6, rows[:, 2], rows[:, 3] / 1e9
+
+        steps = np.diff(pts)
+        period = np.median(steps[steps > 0]) if np.any(steps > 0) else 0.
+        if period > 0:
+            skipped = int(np.sum(np.round(steps[steps > 1.5 * period] / period) - 1))
+            print('frame period -> {:.2f} ms, skipped -> {}, repeated -> {}, out of order -> {}'.format(
+                period * 1000, skipped, int(np.sum(steps == 0)), int(np.sum(steps < 0))))
+
+        # wall clock against pts: the slope is the rate of the sender clock, its residuals the capture jitter
+        slope, intercept = np.polyfit(pts - pts[0], wall - wall[0], 1)
+        residuals = wall - wall[0] - (slope * (pts - pts[0]) + intercept)
+        print('wall clock drift against pts -> {:.1f} ppm, capture jitter -> {:.2f} ms'.format(
+            (slope - 1) * 1e6, np.std(residuals) * 1000))
+
+        if not np.all(np.isnan(stream_pts)):
+            offset = stream_pts - pts
+            offset = offset[~np.isnan(offset)]
+            print('stream pts - barcode pts -> first {:.2f} ms, drift {:.2f} ms'.format(
+                offset[0] * 1000, (offset[-1] - offset[0]) * 1000))
+
+        if self.live:
+            latency = (received - wall) * 1000
+            print('glass to glass latency -> avg {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms'.format(
+                np.mean(latency), np.percentile(latency, 50), np.percentile(latency, 95), np.max(latency)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timestamp barcode analyzer')
+    parser.add_argument('location', help='file or URI, e.g. capture.mp4 or rtsp://127.0.0.1:8554/stream')
+    parser.add_argument('--frames', type=int, help='stop after this many frames, live streams never end otherwise')
+    parser.add_argument('--bits-per-row', type=int, default=48)
+    parser.add_argument('--top', type=int, default=0, help='first row of the barcode strip')
+    parser.add_argument('--live', action='store_true', default=None,
+                        help='report latency against the receive time, the default for anything but files')
+    parser.add_argument('--csv', help='also write every decoded frame to this csv file')
+    args = parser.parse_args()
+
+    Gst.init(None)
+    uri = to_uri(args.location)
+    live = args.live if args.live is not None else not uri.startswith('file://')
+    csv = open(args.csv, 'w') if args.csv else None
+    analyzer = BarcodeAnalyzer(args.bits_per_row, args.top, live, csv)
+
+    pipeline = Gst.parse_launch('uridecodebin uri={} ! videoconvert ! video/x-raw,format=GRAY8 '
+                                '! appsink name=sink sync=false max-buffers=8'.format(uri))
+    sink = pipeline.get_by_name('sink')
+    pipeline.set_state(Gst.State.PLAYING)
+    info = None
+    try:
+        while args.frames is None or analyzer.frames < args.frames:
+            sample = sink.emit('pull-sample')
+            if sample is None:
+                break
+            received = time()
+            if info is None:
+                info = GstVideo.VideoInfo()
+                info.from_caps(sample.get_caps())
+            buf = sample.get_buffer()
+            ok, mapping = buf.map(Gst.MapFlags.READ)
+            if not ok:
+                continue
+            try:
+                # rows of a GRAY8 frame are padded to the stride
+                luma = np.ndarray((info.height, info.stride[0]), np.uint8, buffer=mapping.data)[:, :info.width]
+                analyzer.analyze(luma, buf.pts, received)
+            finally:
+                buf.unmap(mapping)
+    except KeyboardInterrupt:
+        pass
+    message = pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+    if message is not None:
+        print('error -> {}'.format(message.parse_error().debug))
+    pipeline.set_state(Gst.State.NULL)
+    if csv is not None:
+        csv.close()
+    analyzer.report()
+
+
+if __name__ == '__main__':
+    main()